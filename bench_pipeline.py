@@ -0,0 +1,230 @@
+"""
+整條處理流程 (分析 → 修改 → 匯出) 的效能基準，使用可重現的合成 PDF：
+
+    python bench_pipeline.py
+    python bench_pipeline.py --kinds text mixed --pages 1 50 500 --formats pdf vector
+    python bench_pipeline.py --history bench_history.jsonl   # 追加一筆紀錄，方便追蹤趨勢
+
+合成文件有三種：text (純文字層)、scanned (整頁圖片，必須 OCR)、mixed (文字層 + 含字的圖片)。
+同樣的 --seed 產生的 PDF 內容完全相同。每個 (種類, 頁數) 在獨立的子行程中執行，
+每個階段開始前把 RSS 高水位重設 (Linux)，所以 peak RSS 是該階段自己的高水位；rss_start 是階段開始時的 RSS
+(例如分析時載入的 ONNX 模型)，兩者相減就是這個階段增加的記憶體。
+不支援重設的平台 peak_rss_per_stage 為 false，peak RSS 是子行程到該階段結束為止的高水位。
+各階段的細項耗時來自 pdf_metrics。
+OCR 快取一律不用，量到的是實際推論的成本。
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import pikepdf
+from PIL import Image, ImageDraw, ImageFont
+
+KINDS = ("text", "scanned", "mixed")
+FORMATS = ("pdf", "vector", "pptx")
+PAGE_SIZE = (612, 792)   # Letter，單位為點
+SCAN_DPI = 150
+WORDS = ("alpha", "bravo", "charlie", "delta", "echo", "foxtrot", "golf", "hotel",
+         "india", "juliet", "kilo", "lima", "mike", "november", "oscar", "papa")
+REPLACE_RULES = {"e": "E"}
+
+
+# --- 合成 PDF ---
+def _page_lines(rng, page_idx, n_lines=12):
+    lines = [f"Page {page_idx + 1}"]
+    lines += [" ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 7))) for _ in range(n_lines - 1)]
+    return lines
+
+
+def _text_stream(lines, x=72, y=720, size=14, leading=24):
+    ops = ["BT", f"/F1 {size} Tf", f"{leading} TL", f"{x} {y} Td"]
+    for line in lines:
+        ops.append(f"({line}) Tj T*")
+    ops.append("ET")
+    return "\n".join(ops).encode("ascii")
+
+
+def _text_image(lines, width, height, size):
+    img = Image.new("L", (width, height), 255)
+    draw = ImageDraw.Draw(img)
+    font = ImageFont.load_default(size)
+    for i, line in enumerate(lines):
+        draw.text((size, size + i * size * 1.7), line, fill=0, font=font)
+    return img
+
+
+def _image_xobject(pdf, img):
+    xobj = pikepdf.Stream(pdf, zlib.compress(img.tobytes()))
+    xobj.Type = pikepdf.Name.XObject
+    xobj.Subtype = pikepdf.Name.Image
+    xobj.Width, xobj.Height = img.size
+    xobj.ColorSpace = pikepdf.Name.DeviceGray
+    xobj.BitsPerComponent = 8
+    xobj.Filter = pikepdf.Name.FlateDecode
+    return xobj
+
+
+def make_pdf(path, kind, pages, seed=0):
+    rng = random.Random(f"{seed}:{kind}")
+    pdf = pikepdf.new()
+    font = pdf.make_indirect(pikepdf.Dictionary(
+        Type=pikepdf.Name.Font, Subtype=pikepdf.Name.Type1, BaseFont=pikepdf.Name.Helvetica))
+    pw, ph = PAGE_SIZE
+    for i in range(pages):
+        lines = _page_lines(rng, i)
+        page = pdf.add_blank_page(page_size=PAGE_SIZE)
+        resources = pikepdf.Dictionary(Font=pikepdf.Dictionary(F1=font))
+        content = []
+        if kind == "scanned":
+            scale = SCAN_DPI / 72
+            img = _text_image(lines, int(pw * scale), int(ph * scale), size=30)
+            resources.XObject = pikepdf.Dictionary(Im1=_image_xobject(pdf, img))
+            content.append(f"q {pw} 0 0 {ph} 0 0 cm /Im1 Do Q".encode())
+        else:
+            content.append(_text_stream(lines))
+        if kind == "mixed":
+            # 頁面下方放一張含字的圖片 (例如截圖)，只有這一塊需要 OCR
+            img = _text_image(_page_lines(rng, i, 3), 900, 260, size=36)
+            resources.XObject = pikepdf.Dictionary(Im1=_image_xobject(pdf, img))
+            content.append(b"q 432 0 0 125 90 90 cm /Im1 Do Q")
+        page.Resources = resources
+        page.Contents = pdf.make_stream(b"\n".join(content))
+    pdf.save(path)
+    return path
+
+
+# --- 量測 ---
+def _mb(n):
+    return round(n / 1024 / 1024, 1) if n is not None else None
+
+
+class _Stage:
+    """with _Stage(result, "edit") as stat: ...  記錄耗時、開始時的 RSS 與這段期間的 RSS 高水位。"""
+
+    def __init__(self, result, name):
+        self.result = result
+        self.stat = result["stages"][name] = {}
+
+    def __enter__(self):
+        from pdf_metrics import current_rss_bytes, reset_peak_rss
+        self.result["peak_rss_per_stage"] = reset_peak_rss()
+        self.stat["rss_start_mb"] = _mb(current_rss_bytes())
+        self.start = time.perf_counter()
+        return self.stat
+
+    def __exit__(self, *exc):
+        from pdf_metrics import peak_rss_bytes
+        self.stat["seconds"] = time.perf_counter() - self.start
+        self.stat["peak_rss_mb"] = _mb(peak_rss_bytes())
+
+
+def _run_case(path, formats, queue):
+    from pdf_engine import analyze, apply_edits, export, load, replace_rules_to_edits
+    from pdf_metrics import METRICS
+
+    result = {"stages": {}}
+    doc = load(path)
+    n = doc.page_count
+
+    with _Stage(result, "analyze"):
+        ocr_results = analyze(doc)
+
+    with _Stage(result, "edit") as stat:
+        edits = replace_rules_to_edits(ocr_results, REPLACE_RULES)
+        pages_data, edit_ops = apply_edits(doc, ocr_results, edits)
+        stat["edits"] = len(edits)
+    result["boxes"] = sum(len(b) for b in ocr_results.values())
+
+    for fmt in formats:
+        fd, out = tempfile.mkstemp(suffix=".pptx" if fmt == "pptx" else ".pdf")
+        os.close(fd)
+        try:
+            with _Stage(result, f"export.{fmt}") as stat:
+                export(doc, out, fmt, pages_data, edit_ops)
+            stat["bytes"] = os.path.getsize(out)
+        finally:
+            os.remove(out)
+    doc.close()
+
+    for stat in result["stages"].values():
+        stat["pages_per_sec"] = round(n / stat["seconds"], 2) if stat["seconds"] else None
+        stat["seconds"] = round(stat["seconds"], 3)
+    result["breakdown"] = {k: {"count": v["count"], "seconds": round(v["seconds"], 3)}
+                           for k, v in METRICS.to_json()["stages"].items()}
+    queue.put(result)
+
+
+def run_case(path, formats):
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_case, args=(path, formats, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="處理流程效能基準 (合成 PDF)")
+    parser.add_argument("--kinds", nargs="+", default=list(KINDS), choices=KINDS)
+    parser.add_argument("--pages", nargs="+", type=int, default=[1, 10, 50], help="頁數 (1–500)")
+    parser.add_argument("--formats", nargs="+", default=list(FORMATS), choices=FORMATS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="合成 PDF 存放位置 (預設為暫存資料夾，結束後刪除)")
+    parser.add_argument("--history", help="把這次的結果追加到 JSON lines 檔")
+    parser.add_argument("--json", action="store_true", help="以 JSON 輸出")
+    args = parser.parse_args(argv)
+    if any(not 1 <= n <= 500 for n in args.pages):
+        parser.error("--pages 必須介於 1 到 500")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir or tmp
+        os.makedirs(workdir, exist_ok=True)
+        results = []
+        for kind in args.kinds:
+            for pages in args.pages:
+                path = os.path.join(workdir, f"{kind}_{pages}_s{args.seed}.pdf")
+                if not os.path.exists(path):
+                    make_pdf(path, kind, pages, args.seed)
+                result = run_case(path, args.formats)
+                result.update(kind=kind, pages=pages)
+                results.append(result)
+                if not args.json:
+                    print(f"{kind:<8}{pages:>5} 頁 完成", file=sys.stderr)
+
+    record = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "revision": _git_revision(),
+              "seed": args.seed, "cpus": os.cpu_count(), "results": results}
+    if args.history:
+        with open(args.history, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    if args.json:
+        print(json.dumps(record, ensure_ascii=False, indent=2))
+        return
+
+    print(f"{'kind':<9}{'pages':>6}  {'stage':<14}{'sec':>9}{'pages/s':>10}{'start MB':>10}{'peak MB':>9}")
+    for r in results:
+        for stage, stat in r["stages"].items():
+            start, peak = (stat[k] if stat[k] is not None else "-" for k in ("rss_start_mb", "peak_rss_mb"))
+            print(f"{r['kind']:<9}{r['pages']:>6}  {stage:<14}{stat['seconds']:>9}{stat['pages_per_sec']:>10}{start:>10}{peak:>9}")
+    if not all(r.get("peak_rss_per_stage") for r in results):
+        print("(這個平台無法重設 RSS 高水位，peak 是子行程到該階段為止的高水位)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+比較各渲染後端的速度與記憶體：
+
+    python bench_render.py sample.pdf
+    python bench_render.py sample.pdf --pages 50 --dpi 40 150 --json
+
+每個 (後端, DPI) 組合都在獨立的子行程中執行，這樣 peak RSS 才不會互相污染。
+"""
+import argparse
+import json
+import multiprocessing as mp
+import time
+
+from pdf_metrics import peak_rss_bytes
+from pdf_render import RENDERERS, open_renderer
+
+
+def _peak_rss_mb():
+    peak = peak_rss_bytes()
+    return peak / (1024 * 1024) if peak is not None else None
+
+
+def _run_case(path, backend, dpi, max_pages, repeat, queue):
+    with open(path, "rb") as f:
+        data = f.read()
+    renderer = open_renderer(data, backend)
+    n = min(renderer.page_count, max_pages) if max_pages else renderer.page_count
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for i in range(n):
+            renderer.render(i, dpi)
+    elapsed = time.perf_counter() - start
+    renderer.close()
+    queue.put({
+        "backend": backend,
+        "dpi": dpi,
+        "pages": n * repeat,
+        "seconds": round(elapsed, 3),
+        "pages_per_sec": round(n * repeat / elapsed, 2) if elapsed else None,
+        "peak_rss_mb": _peak_rss_mb(),
+    })
+
+
+def run_case(path, backend, dpi, max_pages=None, repeat=1):
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_case, args=(path, backend, dpi, max_pages, repeat, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PDF 渲染後端效能比較")
+    parser.add_argument("pdf")
+    parser.add_argument("--backends", nargs="+", default=list(RENDERERS), choices=list(RENDERERS))
+    parser.add_argument("--dpi", nargs="+", type=int, default=[40, 150])
+    parser.add_argument("--pages", type=int, default=None, help="只測前 N 頁")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="以 JSON 輸出")
+    args = parser.parse_args(argv)
+
+    results = [
+        run_case(args.pdf, backend, dpi, args.pages, args.repeat)
+        for dpi in args.dpi
+        for backend in args.backends
+    ]
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+
+    print(f"{'backend':<12}{'dpi':>6}{'pages':>8}{'sec':>10}{'pages/s':>10}{'peak RSS MB':>14}")
+    for r in results:
+        rss = f"{r['peak_rss_mb']:.1f}" if r["peak_rss_mb"] is not None else "-"
+        print(f"{r['backend']:<12}{r['dpi']:>6}{r['pages']:>8}{r['seconds']:>10}{r['pages_per_sec']:>10}{rss:>14}")
+
+
+if __name__ == "__main__":
+    main()
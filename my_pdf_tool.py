@@ -1,14 +1,23 @@
 import streamlit as st
-import pdfplumber
 from streamlit_drawable_canvas import st_canvas
-from PIL import Image, ImageDraw, ImageFont
-import io
-import img2pdf
-import numpy as np
-from rapidocr_onnxruntime import RapidOCR
-from pptx import Presentation
-from pptx.util import Inches
+from PIL import Image
+import hashlib
+import json
+import uuid
 import os
+from pdf_canvas import CanvasSync, canvas_rects
+from pdf_engine import WORK_DPI, DocumentSession
+from pdf_edit import EditHistory, apply_box_edit, move_box
+from pdf_export import ExportFiles, ExportJob
+from pdf_metrics import METRICS, estimate_size
+from pdf_ocr import BatchOcrJob, OcrCache
+from pdf_server import (OCR_POOL_SIZE, OCR_QUEUE_MAX, OCR_QUEUE_TIMEOUT, SERVER_MODE, SESSION_QUOTA_BYTES,
+                        OcrEnginePool, PageStore, PooledOcrJob, QuotaExceeded, ServerBusy, session_dir, sweep_sessions)
+import importlib.machinery
+
+# Streamlit 把這支腳本當成 __main__ 執行；給它一個 __spec__，
+# 批次 OCR / 匯出用 spawn 啟動的 worker 行程就不會再把整個 UI 重跑一次。
+if __spec__ is None: __spec__ = importlib.machinery.ModuleSpec("__main__", None)
 
 # --- 1. 核心設定 ---
 st.set_page_config(page_title="NotebookLM AI 旗艦版 (Palette Fix)", layout="wide")
@@ -60,74 +69,225 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- 2. 狀態管理 ---
-if 'pages_data' not in st.session_state: st.session_state.pages_data = {} 
-if 'history' not in st.session_state: st.session_state.history = {} 
-if 'history_redo' not in st.session_state: st.session_state.history_redo = {} 
+HISTORY_MAX_BYTES = 64 * 1024 * 1024  # 每個 session 所有頁面共用的 Undo 記憶體預算
+HISTORY_MAX_DEPTH = None              # 每頁步數上限 (None = 不限，只受預算限制)
+
+# 伺服器模式 (PDF_TOOL_SERVER=1) 下，修改後的頁面與 Undo 裁切圖存在磁碟上 (每個 session 一個資料夾、有容量上限)，
+# session_state 只留索引；session 結束時資料夾會被刪除。
+if 'session_id' not in st.session_state: st.session_state.session_id = uuid.uuid4().hex
+if 'pages_data' not in st.session_state:
+    if SERVER_MODE:
+        sweep_sessions()
+        st.session_state.pages_data = PageStore(os.path.join(session_dir(st.session_state.session_id), "pages"), SESSION_QUOTA_BYTES)
+    else:
+        st.session_state.pages_data = {}
+if 'history' not in st.session_state:
+    store = PageStore(os.path.join(session_dir(st.session_state.session_id), "history")) if SERVER_MODE else None
+    st.session_state.history = EditHistory(HISTORY_MAX_BYTES, HISTORY_MAX_DEPTH, store)
+if 'edit_ops' not in st.session_state: st.session_state.edit_ops = {}  # 頁碼 → 目前生效的文字修改 (向量匯出用)
+if 'export_job' not in st.session_state: st.session_state.export_job = None  # (編輯狀態鍵, ExportJob)
+if 'export_cache' not in st.session_state: st.session_state.export_cache = ExportFiles()  # 格式 → (編輯狀態鍵, 檔案路徑)
+if 'download_ready' not in st.session_state: st.session_state.download_ready = None  # 這次 rerun 要放上下載按鈕的編輯狀態鍵
+if 'export_error' not in st.session_state: st.session_state.export_error = None
 if 'ocr_results' not in st.session_state: st.session_state.ocr_results = {} 
 if 'current_page' not in st.session_state: st.session_state.current_page = 0
 if 'selected_index' not in st.session_state: st.session_state.selected_index = 0
 if 'editing_text' not in st.session_state: st.session_state.editing_text = ""
-if 'canvas_key' not in st.session_state: st.session_state.canvas_key = 0 
+if 'canvas_sync' not in st.session_state: st.session_state.canvas_sync = None  # 目前頁面的 CanvasSync
+if 'page_rev' not in st.session_state: st.session_state.page_rev = {}
+if 'thumb_window' not in st.session_state: st.session_state.thumb_window = 0
+if 'ocr_job' not in st.session_state: st.session_state.ocr_job = None
+if 'ocr_job_errors' not in st.session_state: st.session_state.ocr_job_errors = []
 
 # --- 3. 載入 RapidOCR ---
+# 所有 session 共用的引擎池；一般模式只有一個引擎、不限排隊，伺服器模式有大小與排隊上限。
 @st.cache_resource
-def get_ocr_engine():
-    return RapidOCR(det_db_unclip_ratio=1.3) 
+def get_ocr_pool():
+    if SERVER_MODE:
+        return OcrEnginePool(OCR_POOL_SIZE, OCR_QUEUE_MAX, OCR_QUEUE_TIMEOUT,
+                             threads=max(1, (os.cpu_count() or 1) // OCR_POOL_SIZE))
+    return OcrEnginePool()
 
-# 字體設定
-FONT_DIR = "fonts"
-FONT_PATH_NORMAL = os.path.join(FONT_DIR, "msjh.ttc")
-FONT_PATH_BOLD = os.path.join(FONT_DIR, "msjhbd.ttc")
-
-if not os.path.exists(FONT_PATH_BOLD): FONT_PATH_BOLD = FONT_PATH_NORMAL
-if not os.path.exists(FONT_PATH_NORMAL): 
-    FONT_PATH_NORMAL = None 
-    FONT_PATH_BOLD = None
+@st.cache_resource
+def get_ocr_cache():
+    return OcrCache()
 
 DISPLAY_WIDTH = 800 
-
-# --- 關鍵修正：針對雲端 P 模式與透明圖層的終極清洗 (暴力白底版) ---
-def sanitize_image(pil_image):
-    """
-    不管圖片原本是什麼格式，一律建立一張「純白」的底圖，
-    然後把原圖貼上去。這能確保透明背景一定會變成白色，解決變黑問題。
-    """
-    # 1. 確保原圖是 RGBA (包含透明度資訊)，這樣貼上時才不會破圖
-    pil_image = pil_image.convert('RGBA')
-    
-    # 2. 建立一張同樣大小的「純白色」底圖
-    new_image = Image.new('RGB', pil_image.size, (255, 255, 255))
-    
-    # 3. 將原圖貼在白底上 (使用 alpha 作為遮罩)
-    new_image.paste(pil_image, (0, 0), pil_image)
-    
-    # 4. 直接回傳這張新的 RGB 圖片
-    return new_image
+EXPORT_FORMATS = {"PDF": "pdf", "PDF (向量文字)": "vector", "PPTX": "pptx"}
+EXPORT_FILES = {
+    "pdf": ("💾 下載 PDF", "final_cloud_fixed.pdf"),
+    "vector": ("💾 下載 PDF", "final_vector.pdf"),
+    "pptx": ("💾 下載 PPTX", "final_cloud_fixed.pptx"),
+}
+THUMB_DPI = 40
+THUMBS_PER_WINDOW = 10      # 側欄一次只渲染這麼多張縮圖
+THUMB_CACHE_ENTRIES = 2000  # 縮圖快取上限 (LRU)
+# 同時保留的已解析文件數 (所有 session 共用)；被淘汰的文件在沒有人使用後自動關閉
+DOC_CACHE_ENTRIES = int(os.environ.get("PDF_TOOL_DOC_CACHE", "16" if SERVER_MODE else "4"))
+DEBUG_PANEL = os.environ.get("PDF_TOOL_DEBUG") == "1"  # 側欄顯示效能面板
+# st.download_button 會把整個檔案讀成 bytes 放進記憶體中的媒體檔管理員 (傳檔案物件也一樣)，
+# 所以超過這個大小的匯出檔不經瀏覽器下載，改請使用者用命令列 (pdf_engine.py) 匯出。
+DOWNLOAD_MAX_BYTES = int(os.environ.get("PDF_TOOL_DOWNLOAD_MAX_MB", "200")) * 1024 * 1024
+
+@st.cache_resource(max_entries=DOC_CACHE_ENTRIES, show_spinner=False)
+def open_document(doc_hash, _uploaded_file):
+    return DocumentSession(_uploaded_file.getvalue())
+
+# --- 縮圖快取 ---
+# 原始頁面以 (檔案雜湊, 頁碼) 為鍵，跨 rerun、跨使用者共用；
+# 已修改的頁面另以 (session, 頁碼, 版本) 為鍵，只有在 pages_data 變動後才重繪。
+def get_doc_hash(uploaded_file):
+    if st.session_state.get('doc_file_id') != uploaded_file.file_id:
+        st.session_state.doc_hash = hashlib.sha1(uploaded_file.getvalue()).hexdigest()
+        st.session_state.doc_file_id = uploaded_file.file_id
+    return st.session_state.doc_hash
+
+@st.cache_data(max_entries=THUMB_CACHE_ENTRIES, show_spinner=False)
+def get_page_thumbnail(doc_hash, page_idx, _doc):
+    return _doc.rasterize(page_idx, THUMB_DPI)
+
+@st.cache_data(max_entries=THUMB_CACHE_ENTRIES, show_spinner=False)
+def get_edited_thumbnail(session_id, page_idx, rev, _pages):
+    _img = _pages[page_idx]
+    scale = THUMB_DPI / WORK_DPI
+    return _img.resize((max(1, int(_img.width * scale)), max(1, int(_img.height * scale))), Image.BILINEAR)
+
+def mark_page_edited(page_idx):
+    st.session_state.page_rev[page_idx] = st.session_state.page_rev.get(page_idx, 0) + 1
+
+# --- 批次 OCR ---
+# 整份文件丟給背景 process pool (伺服器模式則是共用的引擎池)，這裡以 fragment 每秒輪詢一次，
+# 把完成的頁面寫回 ocr_results。
+fragment = getattr(st, "fragment", None) or st.experimental_fragment
+
+def start_batch_ocr(doc):
+    pages = [i for i in range(doc.page_count) if i not in st.session_state.ocr_results]
+    if pages:
+        if SERVER_MODE:
+            st.session_state.ocr_job = PooledOcrJob(doc, pages, WORK_DPI, get_ocr_pool(), get_ocr_cache())
+        else:
+            st.session_state.ocr_job = BatchOcrJob(doc.data, pages, WORK_DPI, backend=doc.renderer.name,
+                                                     cache_path=get_ocr_cache().path)
+        st.session_state.ocr_job_errors = []
+
+def collect_batch_results(job, curr):
+    """把已完成的頁面寫回 ocr_results；目前頁面有新結果時回傳 True。"""
+    needs_rerun = False
+    for page_idx, boxes in job.drain():
+        if page_idx in st.session_state.ocr_results: continue
+        st.session_state.ocr_results[page_idx] = boxes
+        if page_idx == curr:
+            st.session_state.selected_index = 0 if boxes else None
+            needs_rerun = True
+    return needs_rerun
+
+@fragment(run_every=1)
+def batch_ocr_panel(curr):
+    job = st.session_state.ocr_job
+    if job is None: return
+
+    # 先看是否完成再取結果：完成之後才 drain，最後一頁不會在兩次呼叫之間漏掉
+    done = job.done
+    needs_rerun = collect_batch_results(job, curr)
+    if done:
+        st.session_state.ocr_job = None
+        st.session_state.ocr_job_errors = sorted(job.errors)
+        st.rerun()
+
+    st.progress(job.progress, text=f"📚 批次分析中… {job.completed}/{job.total} 頁")
+    if st.button("⏹️ 取消批次分析", use_container_width=True):
+        job.cancel()
+        collect_batch_results(job, curr)  # 取消前已完成的頁面照樣保留
+        st.session_state.ocr_job = None
+        st.rerun()
+    if needs_rerun: st.rerun()
+
+# --- 背景匯出 ---
+# 匯出在背景執行緒 + process pool 中進行；完成的檔案以「文件雜湊 + 格式 + 每頁版本」為鍵快取，
+# 編輯狀態沒變時再按一次下載不會重做。download_button 每次 rerun 都會把整個檔案讀進記憶體並雜湊，
+# 所以下載按鈕只在匯出剛完成、或使用者按「準備下載」後的那一次 rerun 出現。
+def export_state_key(doc_hash, fmt):
+    return (doc_hash, fmt, tuple(sorted(st.session_state.page_rev.items())))
+
+def start_export(doc, doc_hash, fmt):
+    job = ExportJob(fmt, doc.data, [doc.page_size(i) for i in range(doc.page_count)], WORK_DPI,
+                    edited=st.session_state.pages_data, edit_ops=st.session_state.edit_ops,
+                    backend=doc.renderer.name)
+    st.session_state.export_job = (export_state_key(doc_hash, fmt), job)
+    st.session_state.export_error = None
+
+def cache_export(key, path):
+    st.session_state.export_cache[key[1]] = (key, path)
+    st.session_state.download_ready = key
+
+@fragment(run_every=1)
+def export_panel():
+    key, job = st.session_state.export_job
+    if job.done:
+        st.session_state.export_job = None
+        if job.error is not None: st.session_state.export_error = str(job.error)
+        elif job.path: cache_export(key, job.path)
+        st.rerun()
+
+    st.progress(job.progress, text=f"匯出中… {job.completed}/{job.total} 頁")
+    if st.button("⏹️ 取消匯出", use_container_width=True):
+        job.cancel()
+        st.session_state.export_job = None
+        st.rerun()
 
 # --- 歷史紀錄 ---
-def save_history(page_idx, current_img_bytes):
-    if page_idx not in st.session_state.history: st.session_state.history[page_idx] = []
-    if len(st.session_state.history[page_idx]) > 10: st.session_state.history[page_idx].pop(0)
-    st.session_state.history[page_idx].append(current_img_bytes)
-    if page_idx in st.session_state.history_redo: st.session_state.history_redo[page_idx] = []
-
+# pages_data 存的是 RGB 圖片 (伺服器模式在磁碟上，取出的是副本，改完要寫回)；
+# Undo / Redo 由 EditHistory 把區塊補丁貼回去。
+# edit_ops 同步記錄每頁目前生效的修改 (Undo 一定是撤銷最後一筆)。
 def perform_undo(page_idx):
-    if page_idx in st.session_state.history and st.session_state.history[page_idx]:
-        current_state = st.session_state.pages_data.get(page_idx)
-        if current_state:
-            if page_idx not in st.session_state.history_redo: st.session_state.history_redo[page_idx] = []
-            st.session_state.history_redo[page_idx].append(current_state)
-        st.session_state.pages_data[page_idx] = st.session_state.history[page_idx].pop()
-        return True
-    return False
+    img = st.session_state.pages_data.get(page_idx)
+    entry = st.session_state.history.undo(page_idx, img) if img is not None else None
+    if entry is None: return False
+    st.session_state.pages_data[page_idx] = img
+    if st.session_state.edit_ops.get(page_idx): st.session_state.edit_ops[page_idx].pop()
+    mark_page_edited(page_idx)
+    return True
 
 def perform_redo(page_idx):
-    if page_idx in st.session_state.history_redo and st.session_state.history_redo[page_idx]:
-        current_state = st.session_state.pages_data.get(page_idx)
-        if current_state: st.session_state.history[page_idx].append(current_state)
-        st.session_state.pages_data[page_idx] = st.session_state.history_redo[page_idx].pop()
-        return True
-    return False
+    img = st.session_state.pages_data.get(page_idx)
+    entry = st.session_state.history.redo(page_idx, img) if img is not None else None
+    if entry is None: return False
+    st.session_state.pages_data[page_idx] = img
+    if entry.op is not None: st.session_state.edit_ops.setdefault(page_idx, []).append(entry.op)
+    mark_page_edited(page_idx)
+    return True
+
+# --- 效能面板 ---
+# 設定 PDF_TOOL_DEBUG=1 時在側欄顯示各階段耗時、記憶體與 session 大小，並可匯出 JSON / Prometheus。
+def debug_panel():
+    sizes = {k: estimate_size(v) for k, v in st.session_state.to_dict().items()}
+    METRICS.gauge("session_state_bytes", sum(sizes.values()))
+    data = METRICS.to_json()
+    mb = lambda n: f"{n / 1024 / 1024:.1f} MB" if n is not None else "-"
+
+    with st.sidebar.expander("⏱️ 效能", expanded=True):
+        c1, c2, c3 = st.columns(3)
+        c1.metric("RSS", mb(data["memory"]["rss_bytes"]))
+        c2.metric("RSS 高水位", mb(data["memory"]["peak_rss_bytes"]))
+        c3.metric("Session", mb(data["gauges"]["session_state_bytes"]))
+        st.dataframe([
+            {"階段": stage, "次數": s["count"], "總計 (s)": round(s["seconds"], 3),
+             "平均 (ms)": round(s["seconds"] / s["count"] * 1000, 1), "最長 (ms)": round(s["max"] * 1000, 1)}
+            for stage, s in sorted(data["stages"].items(), key=lambda kv: -kv[1]["seconds"])
+        ], hide_index=True, use_container_width=True)
+        if data["counters"]:
+            st.caption(" · ".join(f"{k}: {v}" for k, v in sorted(data["counters"].items())))
+        st.caption("Session 各欄位")
+        st.dataframe([{"key": k, "MB": round(v / 1024 / 1024, 2)} for k, v in sorted(sizes.items(), key=lambda kv: -kv[1])[:10]],
+                     hide_index=True, use_container_width=True)
+        st.caption("最近的 span")
+        st.dataframe(list(data["spans"])[-20:][::-1], hide_index=True, use_container_width=True)
+        c_json, c_prom = st.columns(2)
+        c_json.download_button("JSON", json.dumps(data, ensure_ascii=False, indent=2), "metrics.json", use_container_width=True)
+        c_prom.download_button("Prometheus", METRICS.to_prometheus(), "metrics.prom", use_container_width=True)
+        if st.button("清除統計", use_container_width=True):
+            METRICS.reset()
+            st.rerun()
 
 # --- 4. 主程式 ---
 st.title("🤖 NotebookLM AI 旗艦版 (雲端顯影修復)")
@@ -135,331 +295,257 @@ st.title("🤖 NotebookLM AI 旗艦版 (雲端顯影修復)")
 uploaded_file = st.file_uploader("請上傳 PDF", type="pdf")
 
 if uploaded_file:
-    # [修正 1] 重置檔案指標，確保 Rerun 後能讀到檔案
-    uploaded_file.seek(0)
+    doc_hash = get_doc_hash(uploaded_file)
+    doc = open_document(doc_hash, uploaded_file)
     
-    with pdfplumber.open(uploaded_file) as pdf:
-        total_pages = len(pdf.pages)
-        col_nav, col_canvas, col_edit = st.columns([1.2, 3.5, 1.5])
-
-        # === 左側：目錄 ===
-        with col_nav:
-            st.subheader("📑 頁面")
-            with st.container(height=700):
-                for i in range(total_pages):
-                    raw_thumb = pdf.pages[i].to_image(resolution=40).original
-                    thumb = sanitize_image(raw_thumb)
-                    
-                    status_text = f"第 {i+1} 頁"
-                    if i in st.session_state.pages_data:
-                        status_text = f"✅ {i+1} (已修)"
+    total_pages = doc.page_count
+    col_nav, col_canvas, col_edit = st.columns([1.2, 3.5, 1.5])
+
+    # === 左側：目錄 ===
+    with col_nav:
+        st.subheader("📑 頁面")
+
+        # 分段顯示：只渲染目前這一段的縮圖
+        n_windows = (total_pages + THUMBS_PER_WINDOW - 1) // THUMBS_PER_WINDOW
+        win = min(st.session_state.thumb_window, n_windows - 1)
+        if n_windows > 1:
+            c_prev, c_label, c_next = st.columns([1, 2, 1])
+            with c_prev:
+                if st.button("⬆️", disabled=win == 0, use_container_width=True):
+                    st.session_state.thumb_window = win - 1
+                    st.rerun()
+            with c_label:
+                st.caption(f"{win * THUMBS_PER_WINDOW + 1}–{min((win + 1) * THUMBS_PER_WINDOW, total_pages)} / {total_pages}")
+            with c_next:
+                if st.button("⬇️", disabled=win >= n_windows - 1, use_container_width=True):
+                    st.session_state.thumb_window = win + 1
+                    st.rerun()
 
-                    st.markdown(f'<div class="thumb-box" style="border-bottom: 1px solid #ddd;">', unsafe_allow_html=True)
-                    st.image(thumb, use_column_width=True)
+        with st.container(height=700):
+            for i in range(win * THUMBS_PER_WINDOW, min((win + 1) * THUMBS_PER_WINDOW, total_pages)):
+                if i in st.session_state.pages_data:
+                    thumb = get_edited_thumbnail(st.session_state.session_id, i,
+                                                 st.session_state.page_rev.get(i, 0),
+                                                 st.session_state.pages_data)
+                else:
+                    thumb = get_page_thumbnail(doc_hash, i, doc)
+                
+                status_text = f"第 {i+1} 頁"
+                if i in st.session_state.pages_data:
+                    status_text = f"✅ {i+1} (已修)"
+
+                st.markdown(f'<div class="thumb-box" style="border-bottom: 1px solid #ddd;">', unsafe_allow_html=True)
+                st.image(thumb, use_column_width=True)
+                st.markdown('</div>', unsafe_allow_html=True)
+
+                btn_container = st.container()
+                with btn_container:
+                    st.markdown('<div class="nav-btn">', unsafe_allow_html=True)
+                    if st.button(status_text, key=f"nav_{i}", use_container_width=True):
+                        st.session_state.current_page = i
+                        st.session_state.selected_index = 0
+                        st.session_state.editing_text = ""
+                        st.rerun()
                     st.markdown('</div>', unsafe_allow_html=True)
-
-                    btn_container = st.container()
-                    with btn_container:
-                        st.markdown('<div class="nav-btn">', unsafe_allow_html=True)
-                        if st.button(status_text, key=f"nav_{i}", use_container_width=True):
-                            st.session_state.current_page = i
-                            st.session_state.selected_index = 0
-                            st.session_state.editing_text = ""
-                            st.session_state.canvas_key += 1
-                            st.rerun()
-                        st.markdown('</div>', unsafe_allow_html=True)
-                    st.markdown("<div style='margin-bottom: 15px;'></div>", unsafe_allow_html=True)
-
-        curr = st.session_state.current_page
-        page = pdf.pages[curr]
-
-        # === 中間：畫布 ===
-        with col_canvas:
-            st.subheader(f"📍 工作區 (第 {curr+1} 頁)")
+                st.markdown("<div style='margin-bottom: 15px;'></div>", unsafe_allow_html=True)
+
+    curr = st.session_state.current_page
+
+    # === 中間：畫布 ===
+    with col_canvas:
+        st.subheader(f"📍 工作區 (第 {curr+1} 頁)")
+
+        if st.session_state.ocr_job is not None:
+            batch_ocr_panel(curr)
+        elif len(st.session_state.ocr_results) < total_pages:
+            if st.button("📚 分析全部頁面 (背景執行)", use_container_width=True):
+                try:
+                    start_batch_ocr(doc)
+                except ServerBusy as e:
+                    st.warning(f"⏳ {e}")
+                else:
+                    st.rerun()
+        if st.session_state.ocr_job_errors:
+            st.warning("以下頁面分析失敗：" + ", ".join(str(i + 1) for i in st.session_state.ocr_job_errors))
+        
+        # 底圖準備
+        if curr in st.session_state.pages_data:
+            bg_img = st.session_state.pages_data[curr]
+        else:
+            bg_img = doc.render(curr)
+
+        # [狀態 A] 尚未分析
+        if curr not in st.session_state.ocr_results:
+            st.image(bg_img, width=DISPLAY_WIDTH)
             
-            # 底圖準備
-            if curr in st.session_state.pages_data:
-                raw_img = Image.open(io.BytesIO(st.session_state.pages_data[curr]))
-                bg_img = sanitize_image(raw_img)
-            else:
-                raw_img = page.to_image(resolution=150).original
-                bg_img = sanitize_image(raw_img)
-
-            # [狀態 A] 尚未分析
-            if curr not in st.session_state.ocr_results:
-                st.image(bg_img, width=DISPLAY_WIDTH)
-                
-                st.info("👇 點擊下方按鈕，AI 將自動偵測每個文字區塊的大小與粗細。")
-                
-                if st.button("🧠 啟動 AI 智慧排版分析", type="primary", use_container_width=True):
-                    with st.spinner("AI 正在分析版面結構與字體..."):
-                        engine = get_ocr_engine()
-                        img_np = np.array(bg_img)
-                        result, elapse = engine(img_np)
-                        
-                        formatted = []
-                        if result:
-                            for item in result:
-                                coords = item[0]
-                                text = item[1]
-                                xs = [int(p[0]) for p in coords]
-                                ys = [int(p[1]) for p in coords]
-                                
-                                width = max(xs) - min(xs)
-                                height = max(ys) - min(ys)
-                                
-                                calc_font_size = max(10, int(height * 0.9))
-                                if calc_font_size > 50: calc_stroke = 2 
-                                elif calc_font_size > 80: calc_stroke = 3 
-                                else: calc_stroke = 0 
-                                
-                                formatted.append({
-                                    'x0': min(xs), 'top': min(ys), 
-                                    'x1': max(xs), 'bottom': max(ys),
-                                    'orig_x0': min(xs), 'orig_top': min(ys),
-                                    'orig_x1': max(xs), 'orig_bottom': max(ys),
-                                    'text': text,
-                                    'font_size': calc_font_size,
-                                    'stroke_width': calc_stroke,
-                                    'color': "#000000"
-                                })
-                        st.session_state.ocr_results[curr] = formatted
-                        st.session_state.selected_index = 0 if formatted else None
-                        st.session_state.canvas_key += 1 
+            st.info("👇 點擊下方按鈕，AI 將自動偵測每個文字區塊的大小與粗細。")
+            
+            if st.button("🧠 啟動 AI 智慧排版分析", type="primary", use_container_width=True):
+                try:
+                    with st.spinner("AI 正在分析版面結構與字體..."), get_ocr_pool().lease() as lease:
+                        # 伺服器模式的引擎都來自共用的引擎池，大頁面的方塊不另外開執行緒平行辨識
+                        boxes = doc.analyze(curr, lease.get, get_ocr_cache(), parallel_tiles=not SERVER_MODE)
+                except ServerBusy as e:
+                    st.warning(f"⏳ {e}")
+                else:
+                    st.session_state.ocr_results[curr] = boxes
+                    st.session_state.selected_index = 0 if boxes else None
                     st.rerun()
 
-            # [狀態 B] 已分析
-            else:
-                initial_drawing = {"version": "4.4.0", "objects": []}
-                scale_factor = DISPLAY_WIDTH / bg_img.width
-                
-                for idx, w in enumerate(st.session_state.ocr_results[curr]):
-                    is_selected = (st.session_state.selected_index == idx)
-                    stroke_color = "rgba(255, 0, 0, 0.9)" if is_selected else "rgba(0, 113, 227, 0.6)"
-                    stroke_width = 3 if is_selected else 1
-                    
-                    rect_obj = {
-                        "type": "rect",
-                        "left": w['x0'] * scale_factor,
-                        "top": w['top'] * scale_factor,
-                        "width": (w['x1'] - w['x0']) * scale_factor,
-                        "height": (w['bottom'] - w['top']) * scale_factor,
-                        "fill": "rgba(0,0,0,0)",
-                        "stroke": stroke_color,
-                        "strokeWidth": stroke_width,
-                        "angle": 0,
-                        "selectable": True,
-                        "data": {"index": idx} 
-                    }
-                    initial_drawing["objects"].append(rect_obj)
-
+        # [狀態 B] 已分析
+        else:
+            # 畫布只在背景 (頁面版本) 改變時才重新掛載，其餘只更新有變動的框
+            sync = st.session_state.canvas_sync
+            if sync is None or not sync.matches(doc_hash[:12], curr):
+                sync = st.session_state.canvas_sync = CanvasSync(doc_hash[:12], curr, DISPLAY_WIDTH)
+            background = sync.set_background(bg_img, st.session_state.page_rev.get(curr, 0))
+            scale_factor = sync.scale
+            boxes = st.session_state.ocr_results[curr]
+
+            with METRICS.span("canvas", curr, objects=len(boxes)):
                 canvas_result = st_canvas(
                     fill_color="rgba(0, 113, 227, 0.1)",
                     stroke_color="rgba(0, 113, 227, 0.8)",
-                    background_image=bg_img, 
-                    initial_drawing=initial_drawing,
+                    background_image=background, 
+                    initial_drawing=sync.drawing(boxes, st.session_state.selected_index),
                     update_streamlit=True,
                     width=DISPLAY_WIDTH,
-                    height=int(bg_img.height * scale_factor),
+                    height=background.height,
                     drawing_mode="transform", 
-                    key=f"canvas_{curr}_{st.session_state.canvas_key}",
+                    key=sync.key(),
                 )
 
-                if canvas_result.json_data and "objects" in canvas_result.json_data:
-                    objects = canvas_result.json_data["objects"]
-                    if len(objects) == len(st.session_state.ocr_results[curr]):
-                        needs_rerun = False
-                        for i, obj in enumerate(objects):
-                            new_x0 = obj["left"] / scale_factor
-                            new_top = obj["top"] / scale_factor
-                            new_x1 = (obj["left"] + obj["width"]) / scale_factor
-                            new_bottom = (obj["top"] + obj["height"]) / scale_factor
-                            old_data = st.session_state.ocr_results[curr][i]
-                            
-                            if (abs(new_x0 - old_data['x0']) > 1 or abs(new_top - old_data['top']) > 1 or
-                                abs(new_x1 - old_data['x1']) > 1 or abs(new_bottom - old_data['bottom']) > 1):
-                                st.session_state.ocr_results[curr][i]['x0'] = new_x0
-                                st.session_state.ocr_results[curr][i]['top'] = new_top
-                                st.session_state.ocr_results[curr][i]['x1'] = new_x1
-                                st.session_state.ocr_results[curr][i]['bottom'] = new_bottom
-                                
-                                if st.session_state.selected_index != i:
-                                    st.session_state.selected_index = i
-                                    st.session_state.editing_text = old_data['text']
-                                    needs_rerun = True
-                                else:
-                                    needs_rerun = True
-                        if needs_rerun: st.rerun()
-
-        # === 右側：編輯面板 ===
-        with col_edit:
-            st.subheader("🛠️ 編輯面板")
-            
-            c_undo, c_redo = st.columns(2)
-            with c_undo:
-                has_history = (curr in st.session_state.history and len(st.session_state.history[curr]) > 0)
-                if st.button("↩️ 上一步", disabled=not has_history, use_container_width=True):
-                    if perform_undo(curr):
-                        st.session_state.canvas_key += 1
-                        st.rerun()
-            with c_redo:
-                has_redo = (curr in st.session_state.history_redo and len(st.session_state.history_redo[curr]) > 0)
-                if st.button("↪️ 重做", disabled=not has_redo, use_container_width=True):
-                    if perform_redo(curr):
-                        st.session_state.canvas_key += 1
-                        st.rerun()
-
-            current_results = st.session_state.ocr_results.get(curr, [])
-            if not current_results:
-                st.info("等待分析...")
-            else:
-                with st.expander("⚡ 智慧重算"):
-                    if st.button("🔄 依據框高重新計算所有字體", use_container_width=True):
-                        for item in st.session_state.ocr_results[curr]:
-                            h = item['bottom'] - item['top']
-                            f_size = max(10, int(h * 0.9))
-                            item['font_size'] = f_size
-                            if f_size > 50: item['stroke_width'] = 2
-                            elif f_size > 80: item['stroke_width'] = 3
-                            else: item['stroke_width'] = 0
-                        st.success("已重算！")
+            if canvas_result.json_data and "objects" in canvas_result.json_data:
+                objects = canvas_result.json_data["objects"]
+                if len(objects) == len(boxes):
+                    changed = boxes.update_from_rects(canvas_rects(objects), scale_factor)
+                    if len(changed):
+                        i = int(changed[-1])
+                        if st.session_state.selected_index != i:
+                            st.session_state.selected_index = i
+                            st.session_state.editing_text = boxes.text[i]
                         st.rerun()
 
-                st.markdown("---")
+    # === 右側：編輯面板 ===
+    with col_edit:
+        st.subheader("🛠️ 編輯面板")
+        
+        c_undo, c_redo = st.columns(2)
+        with c_undo:
+            has_history = st.session_state.history.can_undo(curr)
+            if st.button("↩️ 上一步", disabled=not has_history, use_container_width=True):
+                if perform_undo(curr):
+                    st.rerun()
+        with c_redo:
+            has_redo = st.session_state.history.can_redo(curr)
+            if st.button("↪️ 重做", disabled=not has_redo, use_container_width=True):
+                if perform_redo(curr):
+                    st.rerun()
 
-                options = [f"{i+1}. {w['text'][:15]}..." for i, w in enumerate(current_results)]
-                if st.session_state.selected_index is None or st.session_state.selected_index >= len(options):
-                    st.session_state.selected_index = 0
-                
-                selected_opt = st.selectbox("🎯 選擇區塊", options, index=st.session_state.selected_index)
-                
-                new_index = options.index(selected_opt)
-                if new_index != st.session_state.selected_index:
-                    st.session_state.selected_index = new_index
-                    w = current_results[new_index]
-                    st.session_state.editing_text = w['text']
-                    st.session_state.canvas_key += 1
+        current_results = st.session_state.ocr_results.get(curr, [])
+        if not current_results:
+            st.info("等待分析...")
+        else:
+            with st.expander("⚡ 智慧重算"):
+                if st.button("🔄 依據框高重新計算所有字體", use_container_width=True):
+                    current_results.recompute_fonts()
+                    st.success("已重算！")
                     st.rerun()
 
-                idx = st.session_state.selected_index
-                w = current_results[idx]
-                
-                if not st.session_state.editing_text:
-                    st.session_state.editing_text = w['text']
+            st.markdown("---")
 
-                if 'font_size' not in w: w['font_size'] = 30
-                if 'stroke_width' not in w: w['stroke_width'] = 1
-                if 'color' not in w: w['color'] = "#000000"
+            options = [f"{i+1}. {text[:15]}..." for i, text in enumerate(current_results.text)]
+            if st.session_state.selected_index is None or st.session_state.selected_index >= len(options):
+                st.session_state.selected_index = 0
+            
+            selected_opt = st.selectbox("🎯 選擇區塊", options, index=st.session_state.selected_index)
+            
+            new_index = options.index(selected_opt)
+            if new_index != st.session_state.selected_index:
+                st.session_state.selected_index = new_index
+                w = current_results[new_index]
+                st.session_state.editing_text = w['text']
+                st.rerun()
+
+            idx = st.session_state.selected_index
+            w = current_results[idx]
+            
+            if not st.session_state.editing_text:
+                st.session_state.editing_text = w['text']
 
-                with st.form("edit_form"):
-                    st.caption(f"編輯中：#{idx+1}")
-                    new_val = st.text_area("內容", value=st.session_state.editing_text, height=100)
-                    
-                    c_pos1, c_pos2 = st.columns(2)
-                    with c_pos1: adj_x = st.number_input("X", value=int(w['x0']), step=5)
-                    with c_pos2: adj_y = st.number_input("Y", value=int(w['top']), step=5)
-                        
-                    st.markdown("---")
-                    c1, c2 = st.columns(2)
-                    with c1:
-                        f_size = st.number_input("字體大小", 10, 500, w['font_size'])
-                    with c2:
-                        f_color = st.color_picker("顏色", w['color'])
-                    
-                    stroke_w = st.slider("筆畫加粗", 0, 5, w['stroke_width'])
-                    
-                    submitted = st.form_submit_button("✨ 套用修改", use_container_width=True, type="primary")
+            with st.form("edit_form"):
+                st.caption(f"編輯中：#{idx+1}")
+                new_val = st.text_area("內容", value=st.session_state.editing_text, height=100)
                 
-                if submitted:
-                    st.session_state.editing_text = new_val
-                    
-                    # 存 Undo (記得清洗)
-                    if curr in st.session_state.pages_data:
-                        current_img_bytes = st.session_state.pages_data[curr]
-                    else:
-                        current_img = page.to_image(resolution=150).original
-                        current_img = sanitize_image(current_img)
-                        b = io.BytesIO()
-                        current_img.save(b, format="PNG")
-                        current_img_bytes = b.getvalue()
-                    save_history(curr, current_img_bytes)
-                    
-                    # 繪圖
-                    if curr in st.session_state.pages_data:
-                        base = Image.open(io.BytesIO(st.session_state.pages_data[curr]))
-                        base = sanitize_image(base)
-                    else:
-                        base = page.to_image(resolution=150).original
-                        base = sanitize_image(base)
-                    
-                    final_draw = ImageDraw.Draw(base)
-                    
-                    if 'orig_x0' in w:
-                        erase_coords = [w['orig_x0'], w['orig_top'], w['orig_x1'], w['orig_bottom']]
-                    else:
-                        erase_coords = [w['x0'], w['top'], w['x1'], w['bottom']]
-                    final_draw.rectangle(erase_coords, fill="white")
-                    
-                    try:
-                        if FONT_PATH_NORMAL and os.path.exists(FONT_PATH_NORMAL):
-                             font = ImageFont.truetype(FONT_PATH_NORMAL, f_size)
-                        else:
-                             font = ImageFont.load_default()
-                    except:
-                        font = ImageFont.load_default()
+                c_pos1, c_pos2 = st.columns(2)
+                with c_pos1: adj_x = st.number_input("X", value=int(w['x0']), step=5)
+                with c_pos2: adj_y = st.number_input("Y", value=int(w['top']), step=5)
                     
-                    final_draw.text((adj_x, adj_y), new_val, fill=f_color, font=font, stroke_width=stroke_w)
-                    
-                    buf = io.BytesIO()
-                    base.save(buf, format="PNG")
-                    st.session_state.pages_data[curr] = buf.getvalue()
-                    
-                    st.session_state.ocr_results[curr][idx]['x0'] = adj_x
-                    st.session_state.ocr_results[curr][idx]['top'] = adj_y
-                    width = w['x1'] - w['x0']
-                    height = w['bottom'] - w['top']
-                    st.session_state.ocr_results[curr][idx]['x1'] = adj_x + width
-                    st.session_state.ocr_results[curr][idx]['bottom'] = adj_y + height
-                    
-                    st.session_state.ocr_results[curr][idx]['font_size'] = f_size
-                    st.session_state.ocr_results[curr][idx]['stroke_width'] = stroke_w
-                    st.session_state.ocr_results[curr][idx]['color'] = f_color
+                st.markdown("---")
+                c1, c2 = st.columns(2)
+                with c1:
+                    f_size = st.number_input("字體大小", 10, 500, w['font_size'])
+                with c2:
+                    f_color = st.color_picker("顏色", w['color'])
+                
+                stroke_w = st.slider("筆畫加粗", 0, 5, w['stroke_width'])
+                
+                submitted = st.form_submit_button("✨ 套用修改", use_container_width=True, type="primary")
+            
+            if submitted:
+                st.session_state.editing_text = new_val
+                
+                if curr in st.session_state.pages_data:
+                    base = st.session_state.pages_data[curr]
+                else:
+                    base = doc.render(curr).copy()
+                
+                # 存 Undo：只保留受影響區塊修改前後的裁切圖
+                region, before, op = apply_box_edit(base, w, new_val, (adj_x, adj_y), f_size, f_color, stroke_w)
+                try:
+                    # 先寫回頁面：超過儲存上限時什麼都不改
+                    st.session_state.pages_data[curr] = base
+                except QuotaExceeded as e:
+                    st.error(str(e))
+                else:
+                    st.session_state.history.record(curr, base, region, before, op)
+                    st.session_state.edit_ops.setdefault(curr, []).append(op)
+                    mark_page_edited(curr)
+                    move_box(st.session_state.ocr_results[curr][idx], (adj_x, adj_y), f_size, f_color, stroke_w)
                     
-                    st.session_state.canvas_key += 1
                     st.success("修改成功！")
                     st.rerun()
 
-            st.divider()
-            st.subheader("📦 匯出")
-            export_format = st.radio("格式", ["PDF", "PPTX"], horizontal=True)
-            
-            if st.button("🚀 下載檔案", use_container_width=True):
-                if not st.session_state.pages_data:
-                    st.warning("請先修改內容")
-                else:
-                    img_list = []
-                    for i in range(total_pages):
-                        if i in st.session_state.pages_data:
-                            img_list.append(st.session_state.pages_data[i])
-                        else:
-                            p = pdf.pages[i].to_image(resolution=150).original
-                            p = sanitize_image(p) 
-                            b = io.BytesIO()
-                            p.save(b, format="PNG")
-                            img_list.append(b.getvalue())
-
-                    if export_format == "PDF":
-                        pdf_bytes = img2pdf.convert(img_list)
-                        st.download_button("💾 下載 PDF", pdf_bytes, "final_cloud_fixed.pdf")
-                    else:
-                        prs = Presentation()
-                        prs.slide_width = Inches(13.333)
-                        prs.slide_height = Inches(7.5)
-                        for img_bytes in img_list:
-                            slide = prs.slides.add_slide(prs.slide_layouts[6])
-                            slide.shapes.add_picture(io.BytesIO(img_bytes), 0, 0, width=Inches(13.333))
-                        ppt_out = io.BytesIO()
-                        prs.save(ppt_out)
-                        st.download_button("💾 下載 PPTX", ppt_out.getvalue(), "final_cloud_fixed.pptx")
+        st.divider()
+        st.subheader("📦 匯出")
+        export_format = st.radio("格式", list(EXPORT_FORMATS), horizontal=True)
+        fmt = EXPORT_FORMATS[export_format]
+        cached = st.session_state.export_cache.get(fmt)
+        
+        if st.session_state.export_job is not None:
+            export_panel()
+        elif cached and cached[0] == export_state_key(doc_hash, fmt) and os.path.exists(cached[1]):
+            label, file_name = EXPORT_FILES[fmt]
+            size = os.path.getsize(cached[1])
+            if size > DOWNLOAD_MAX_BYTES:
+                st.warning(f"檔案 {size / 1024 / 1024:.0f} MB 超過網頁下載上限 "
+                           f"({DOWNLOAD_MAX_BYTES // 1024 // 1024} MB)，請改用命令列 pdf_engine.py 匯出")
+            elif st.session_state.download_ready == cached[0]:
+                st.session_state.download_ready = None
+                with open(cached[1], "rb") as f:
+                    st.download_button(label, f, file_name, use_container_width=True)
+            elif st.button(f"📥 準備下載 ({size / 1024 / 1024:.1f} MB)", use_container_width=True):
+                st.session_state.download_ready = cached[0]
+                st.rerun()
+        elif st.button("🚀 下載檔案", use_container_width=True):
+            if not st.session_state.pages_data:
+                st.warning("請先修改內容")
+            else:
+                start_export(doc, doc_hash, fmt)
+                st.rerun()
+        if st.session_state.export_error:
+            st.error(f"匯出失敗：{st.session_state.export_error}")
 else:
     st.info("請上傳 PDF 開始...")
+
+if DEBUG_PANEL: debug_panel()
@@ -0,0 +1,271 @@
+"""
+頁面編輯。
+
+工作中的頁面一律以記憶體中的 RGB 點陣圖保存 (不再每次編輯都 PNG 編碼/解碼)，
+每次修改只在受影響的區塊上繪圖，PNG 編碼延後到匯出時才做。
+Undo / Redo 也只保存受影響區塊修改前後的裁切圖 (EditHistory)。
+"""
+import io
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageDraw, ImageFont
+
+from pdf_metrics import METRICS
+
+# 字體設定
+FONT_DIR = "fonts"
+FONT_PATH_NORMAL = os.path.join(FONT_DIR, "msjh.ttc")
+FONT_PATH_BOLD = os.path.join(FONT_DIR, "msjhbd.ttc")
+
+if not os.path.exists(FONT_PATH_BOLD): FONT_PATH_BOLD = FONT_PATH_NORMAL
+if not os.path.exists(FONT_PATH_NORMAL):
+    FONT_PATH_NORMAL = None
+    FONT_PATH_BOLD = None
+
+FONT_CACHE_ENTRIES = 32                   # 已載入的 FreeTypeFont 數 (LRU)
+TEXT_MASK_CACHE_BYTES = 32 * 1024 * 1024  # 文字遮罩快取上限
+BOLD_STROKE = 2                           # 筆畫加粗到這個程度就改用粗體字型檔
+
+
+# --- 字型與文字遮罩快取 ---
+class FontManager:
+    """
+    msjh.ttc 這類 CJK 字型集很大，每次 truetype() 都要重新解析；這裡把載入過的字型
+    依 (路徑, 大小, 粗細) 放在 LRU 裡，並把排版好的文字遮罩依 (文字, 路徑, 大小, 粗細, 筆畫) 快取，
+    重複的標籤、重播修改 (批次處理、匯出) 都不必再解析字型與排版。
+    """
+
+    def __init__(self, max_fonts=FONT_CACHE_ENTRIES, max_mask_bytes=TEXT_MASK_CACHE_BYTES):
+        self.max_fonts = max_fonts
+        self.max_mask_bytes = max_mask_bytes
+        self.mask_bytes = 0
+        self._fonts = OrderedDict()
+        self._masks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def face(self, stroke_width=0):
+        """(字型檔路徑, 粗細, 剩下要用 stroke 模擬的加粗)；有獨立的粗體檔時，粗筆畫改用粗體字型。"""
+        if stroke_width >= BOLD_STROKE and FONT_PATH_BOLD and FONT_PATH_BOLD != FONT_PATH_NORMAL:
+            return FONT_PATH_BOLD, "bold", stroke_width - BOLD_STROKE
+        return FONT_PATH_NORMAL, "normal", stroke_width
+
+    def font(self, size, path=None, weight="normal"):
+        key = (path, size, weight)
+        with self._lock:
+            if key in self._fonts:
+                self._fonts.move_to_end(key)
+                return self._fonts[key]
+        try:
+            font = ImageFont.truetype(path, size) if path and os.path.exists(path) else ImageFont.load_default()
+        except Exception:
+            font = ImageFont.load_default()
+        with self._lock:
+            self._fonts[key] = font
+            while len(self._fonts) > self.max_fonts:
+                self._fonts.popitem(last=False)
+        return font
+
+    def text_mask(self, text, size, stroke_width=0):
+        """
+        回傳 (mask, (dx, dy))：L 模式的文字遮罩，以及遮罩左上角相對於文字起點的位移，
+        與 ImageDraw.multiline_text 畫在 pos 的結果相同。
+        """
+        path, weight, stroke = self.face(stroke_width)
+        key = (text, path, size, weight, stroke)
+        with self._lock:
+            if key in self._masks:
+                self._masks.move_to_end(key)
+                return self._masks[key]
+        font = self.font(size, path, weight)
+        left, top, right, bottom = ImageDraw.Draw(Image.new("L", (1, 1))).multiline_textbbox(
+            (0, 0), text, font=font, stroke_width=stroke)
+        mask = Image.new("L", (max(1, right - left), max(1, bottom - top)), 0)
+        ImageDraw.Draw(mask).multiline_text((-left, -top), text, fill=255, font=font, stroke_width=stroke)
+        entry = (mask, (left, top))
+        with self._lock:
+            if key not in self._masks:
+                self._masks[key] = entry
+                self.mask_bytes += mask.width * mask.height
+            while self.mask_bytes > self.max_mask_bytes and len(self._masks) > 1:
+                old, _ = self._masks.popitem(last=False)[1]
+                self.mask_bytes -= old.width * old.height
+        return entry
+
+
+FONTS = FontManager()
+
+
+def _clamp_box(box, size):
+    x0, y0, x1, y1 = box
+    return (max(0, int(x0)), max(0, int(y0)), min(size[0], int(x1) + 1), min(size[1], int(y1) + 1))
+
+
+def _text_origin(pos, offset):
+    return int(round(pos[0])) + offset[0], int(round(pos[1])) + offset[1]
+
+
+def text_edit_region(img, erase_box, pos, text, font_size, stroke_width=0):
+    """這次修改會動到的區塊 (擦除框 ∪ 文字外框)，已裁切到圖片範圍內。"""
+    mask, offset = FONTS.text_mask(text, font_size, stroke_width)
+    tx0, ty0 = _text_origin(pos, offset)
+    tx1, ty1 = tx0 + mask.width, ty0 + mask.height
+    ex0, ey0, ex1, ey1 = erase_box
+    return _clamp_box((min(ex0, tx0), min(ey0, ty0), max(ex1, tx1), max(ey1, ty1)), img.size)
+
+
+def apply_text_edit(img, erase_box, pos, text, font_size, color, stroke_width=0):
+    """
+    就地在 img 上擦除 erase_box 並寫入文字，回傳受影響的區塊。
+    只在這個區塊的像素上作業，成本跟框的大小成正比，與整頁大小無關；
+    文字以快取的遮罩貼上，重複的文字不必重新排版。
+    """
+    region = text_edit_region(img, erase_box, pos, text, font_size, stroke_width)
+    ImageDraw.Draw(img).rectangle(list(erase_box), fill="white")
+    mask, offset = FONTS.text_mask(text, font_size, stroke_width)
+    img.paste(color, _text_origin(pos, offset), mask)
+    return region
+
+
+def apply_box_edit(img, box, text, pos, font_size, color="#000000", stroke_width=0):
+    """
+    以 OCR 框為單位的修改：擦除框原本的位置 (orig_*)、在 pos 寫入新文字。
+    回傳 (region, before, op)：受影響區塊、修改前的裁切圖 (給 EditHistory)、
+    以及這次修改的描述 (給向量匯出)。
+    """
+    if 'orig_x0' in box:
+        erase = [box['orig_x0'], box['orig_top'], box['orig_x1'], box['orig_bottom']]
+    else:
+        erase = [box['x0'], box['top'], box['x1'], box['bottom']]
+    with METRICS.span("edit"):
+        region = text_edit_region(img, erase, pos, text, font_size, stroke_width)
+        before = img.crop(region)
+        apply_text_edit(img, erase, pos, text, font_size, color, stroke_width)
+    op = {'erase': erase, 'x': pos[0], 'y': pos[1], 'text': text,
+          'font_size': font_size, 'color': color, 'stroke_width': stroke_width}
+    return region, before, op
+
+
+def move_box(box, pos, font_size, color, stroke_width):
+    """修改後更新 OCR 框：移到新位置並記下字體設定。"""
+    box['x0'], box['top'] = pos
+    width = box['x1'] - box['x0']
+    height = box['bottom'] - box['top']
+    box['x1'] = pos[0] + width
+    box['bottom'] = pos[1] + height
+    box['font_size'] = font_size
+    box['stroke_width'] = stroke_width
+    box['color'] = color
+
+
+def encode_png(img):
+    buf = io.BytesIO()
+    with METRICS.span("png_encode"):
+        img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+# --- 歷史紀錄 ---
+class HistoryEntry:
+    __slots__ = ("seq", "box", "before", "after", "op", "nbytes")
+
+    def __init__(self, seq, box, before, after, op=None):
+        self.seq = seq
+        self.box = box
+        self.before = before
+        self.after = after
+        self.op = op
+        self.nbytes = _image_nbytes(before) + _image_nbytes(after)
+
+
+def _image_nbytes(img):
+    return img.width * img.height * len(img.getbands())
+
+
+class EditHistory:
+    """
+    以區塊補丁記錄每一步修改，Undo / Redo 只需把裁切圖貼回去，
+    成本跟修改範圍的大小成正比。
+
+    所有頁面共用 max_bytes 的記憶體預算，超過時從全域最舊的步驟開始丟棄；
+    max_depth 是每頁最多保留的步數，None 表示不限。
+    store 是存放裁切圖的 {鍵: 圖片} (例如伺服器模式的 PageStore)，None 表示留在記憶體裡。
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_depth=None, store=None):
+        self.max_bytes = max_bytes
+        self.max_depth = max_depth
+        self.store = store
+        self.nbytes = 0
+        self._undo = {}
+        self._redo = {}
+        self._seq = 0
+
+    def can_undo(self, page_idx):
+        return bool(self._undo.get(page_idx))
+
+    def can_redo(self, page_idx):
+        return bool(self._redo.get(page_idx))
+
+    def record(self, page_idx, img, box, before, op=None):
+        """
+        在 img 已經修改完之後呼叫；before 是修改前 box 範圍的裁切圖，
+        op 是這次修改的描述 (向量匯出用)，undo / redo 時會隨 entry 一起回傳。
+        """
+        self._seq += 1
+        entry = HistoryEntry(self._seq, box, before, img.crop(box), op)
+        if self.store is not None:
+            self.store[f"{entry.seq}b"], self.store[f"{entry.seq}a"] = entry.before, entry.after
+            entry.before = entry.after = None
+        self._clear_redo(page_idx)
+        stack = self._undo.setdefault(page_idx, [])
+        stack.append(entry)
+        self.nbytes += entry.nbytes
+        if self.max_depth is not None:
+            while len(stack) > self.max_depth:
+                self._drop(stack.pop(0))
+        self._evict()
+
+    def undo(self, page_idx, img):
+        """還原最後一步，回傳被還原的 entry；沒有可還原的步驟時回傳 None。"""
+        if not self.can_undo(page_idx):
+            return None
+        entry = self._undo[page_idx].pop()
+        img.paste(self._image(entry, "b"), entry.box[:2])
+        self._redo.setdefault(page_idx, []).append(entry)
+        return entry
+
+    def redo(self, page_idx, img):
+        if not self.can_redo(page_idx):
+            return None
+        entry = self._redo[page_idx].pop()
+        img.paste(self._image(entry, "a"), entry.box[:2])
+        self._undo.setdefault(page_idx, []).append(entry)
+        return entry
+
+    def _image(self, entry, side):
+        if self.store is None:
+            return entry.before if side == "b" else entry.after
+        return self.store[f"{entry.seq}{side}"]
+
+    def _drop(self, entry):
+        self.nbytes -= entry.nbytes
+        if self.store is not None:
+            del self.store[f"{entry.seq}b"], self.store[f"{entry.seq}a"]
+
+    def _clear_redo(self, page_idx):
+        for entry in self._redo.pop(page_idx, []):
+            self._drop(entry)
+
+    def _evict(self):
+        # 超過預算時，丟棄所有頁面中最舊的一步 (undo 堆疊底部)
+        while self.nbytes > self.max_bytes:
+            oldest = min(
+                (page for page, stack in self._undo.items() if stack),
+                key=lambda page: self._undo[page][0].seq,
+                default=None,
+            )
+            if oldest is None:
+                break
+            self._drop(self._undo[oldest].pop(0))
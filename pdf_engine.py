@@ -0,0 +1,386 @@
+"""
+不依賴 Streamlit 的處理流程：載入 → 點陣化 → OCR → 套用文字修改 → 匯出。
+
+可以當函式庫使用：
+
+    doc = load("deck.pdf")
+    ocr_results = analyze(doc)
+    pages_data, edit_ops = apply_edits(doc, ocr_results, [{"page": 0, "find": "舊", "text": "新"}])
+    export(doc, "out.pdf", "pdf", pages_data, edit_ops)
+
+也可以從命令列批次處理整個資料夾或 manifest：
+
+    python pdf_engine.py ./decks --out ./done --format vector --replace 舊公司=新公司 --jobs 4
+    python pdf_engine.py --manifest jobs.jsonl --out ./done
+
+manifest 每行一個 JSON：{"pdf": "a.pdf", "edits": [{"page": 0, "index": 3, "text": "新"}]}。
+進度逐行記錄在 --progress 檔 (預設 <out>/progress.jsonl)，中斷後重跑會跳過已完成的文件。
+"""
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from pdf_edit import apply_box_edit, move_box
+from pdf_export import export_vector_pdf, iter_pngs, write_image_pdf, write_pptx
+from pdf_metrics import METRICS
+from pdf_ocr import ANALYSIS_MODE, OCR_CACHE_PATH, OcrCache, TextLayer, analyze_page, create_engine, plan_workers
+from pdf_render import open_renderer
+
+WORK_DPI = 150
+RASTER_CACHE_ENTRIES = 8    # 每份文件保留的頁面點陣圖數 (LRU)
+EXPORT_SUFFIX = {"pdf": ".pdf", "vector": ".pdf", "pptx": ".pptx"}
+
+
+# --- 文件工作階段 ---
+# 每份 PDF 只解析一次，頁面點陣圖依 (頁碼, DPI) 快取。
+# 快取中的圖片是共用的，要在上面畫圖之前必須先 .copy()。
+# 沒有呼叫 close() 的工作階段 (例如被 Streamlit 的快取淘汰) 在最後一個參考消失時自動關閉。
+def _close_all(resources):
+    for resource in resources:
+        resource.close()
+    resources.clear()
+
+
+class DocumentSession:
+    def __init__(self, data, max_rasters=RASTER_CACHE_ENTRIES, backend=None):
+        self.data = data
+        self.renderer = open_renderer(data, backend)
+        self.page_count = self.renderer.page_count
+        self.max_rasters = max_rasters
+        self._rasters = OrderedDict()
+        self._lock = threading.Lock()
+        self._text_layer = None
+        self._resources = [self.renderer]
+        self._finalizer = weakref.finalize(self, _close_all, self._resources)
+
+    def rasterize(self, page_idx, dpi=WORK_DPI):
+        """直接渲染，不經過快取 (縮圖、匯出用)。"""
+        return self.renderer.render(page_idx, dpi)
+
+    def render(self, page_idx, dpi=WORK_DPI):
+        key = (page_idx, dpi)
+        with self._lock:
+            if key in self._rasters:
+                self._rasters.move_to_end(key)
+                return self._rasters[key]
+        img = self.rasterize(page_idx, dpi)
+        with self._lock:
+            self._rasters[key] = img
+            while len(self._rasters) > self.max_rasters:
+                self._rasters.popitem(last=False)
+        return img
+
+    def page_size(self, page_idx):
+        return self.renderer.page_size(page_idx)
+
+    @property
+    def text_layer(self):
+        """PDF 文字層 (第一次用到時才解析)；分析模式為 "ocr" 時是 None。"""
+        if self._text_layer is None and ANALYSIS_MODE != "ocr":
+            # 批次分析的多個執行緒可能同時第一次用到
+            with self._lock:
+                if self._text_layer is None:
+                    self._text_layer = TextLayer(self.data)
+                    self._resources.append(self._text_layer)
+        return self._text_layer
+
+    def analyze(self, page_idx, get_engine, cache=None, dpi=WORK_DPI, parallel_tiles=False):
+        return analyze_page(get_engine, self.render(page_idx, dpi), cache, self.text_layer, page_idx, dpi,
+                            parallel_tiles)
+
+    def close(self):
+        self._finalizer()
+
+
+def load(source, backend=None):
+    """source 可以是檔案路徑或 PDF bytes。"""
+    if isinstance(source, (bytes, bytearray)):
+        return DocumentSession(bytes(source), backend=backend)
+    with open(source, "rb") as f:
+        return DocumentSession(f.read(), backend=backend)
+
+
+def analyze(doc, pages=None, get_engine=None, cache=None, progress=None):
+    """
+    分析指定頁面 (預設全部)：有文字層的頁面直接用文字層，其餘 OCR；回傳 {頁碼: OcrBoxes}。
+    沒有傳入 get_engine 時自己建立引擎，大頁面的方塊也可以平行辨識 (OCR_TILE_WORKERS)。
+    """
+    parallel_tiles = get_engine is None
+    if get_engine is None:
+        engine = []
+        def get_engine():
+            if not engine: engine.append(create_engine())
+            return engine[0]
+    pages = range(doc.page_count) if pages is None else list(pages)
+    results = {}
+    for n, i in enumerate(pages, 1):
+        results[i] = doc.analyze(i, get_engine, cache, parallel_tiles=parallel_tiles)
+        if progress: progress(n, len(pages))
+    return results
+
+
+def _find_box(boxes, edit):
+    if 'index' in edit:
+        return boxes[edit['index']] if 0 <= edit['index'] < len(boxes) else None
+    for box in boxes:
+        if edit['find'] in box['text']:
+            return box
+    return None
+
+
+def apply_edits(doc, ocr_results, edits, pages_data=None, edit_ops=None):
+    """
+    edits：[{"page": 0, "index": 3 或 "find": "原文字", "text": "新文字",
+             (選填) "x", "y", "font_size", "color", "stroke_width"}, ...]
+    用 find 時，text 會取代框內文字中符合的部分；找不到對應框的修改會略過。
+    回傳 (pages_data, edit_ops)，ocr_results 中被修改的框會同步更新。
+    """
+    pages_data = {} if pages_data is None else pages_data
+    edit_ops = {} if edit_ops is None else edit_ops
+    for edit in edits:
+        page_idx = edit['page']
+        box = _find_box(ocr_results.get(page_idx, []), edit)
+        if box is None:
+            continue
+        text = box['text'].replace(edit['find'], edit['text']) if 'find' in edit else edit['text']
+        pos = (edit.get('x', int(box['x0'])), edit.get('y', int(box['top'])))
+        font_size = edit.get('font_size', box['font_size'])
+        color = edit.get('color', box['color'])
+        stroke_width = edit.get('stroke_width', box['stroke_width'])
+
+        img = pages_data.get(page_idx)
+        if img is None:
+            img = doc.render(page_idx).copy()
+        _, _, op = apply_box_edit(img, box, text, pos, font_size, color, stroke_width)
+        pages_data[page_idx] = img
+        edit_ops.setdefault(page_idx, []).append(op)
+        box['text'] = text
+        move_box(box, pos, font_size, color, stroke_width)
+    return pages_data, edit_ops
+
+
+def replace_rules_to_edits(ocr_results, rules):
+    """把 {"舊": "新"} 規則展開成每個符合框的修改。"""
+    edits = []
+    for page_idx, boxes in sorted(ocr_results.items()):
+        for index, box in enumerate(boxes):
+            text = box['text']
+            for old, new in rules.items():
+                text = text.replace(old, new)
+            if text != box['text']:
+                edits.append({'page': page_idx, 'index': index, 'text': text})
+    return edits
+
+
+def export(doc, out_path, fmt="pdf", pages_data=None, edit_ops=None, progress=None):
+    pages_data = pages_data or {}
+
+    def get_page(i):
+        return pages_data[i] if i in pages_data else doc.rasterize(i)
+
+    with open(out_path, "wb") as f, METRICS.span("export", fmt=fmt, pages=doc.page_count):
+        if fmt == "vector":
+            export_vector_pdf(doc.data, edit_ops or {}, WORK_DPI, f)
+        elif fmt == "pdf":
+            write_image_pdf(f, iter_pngs(doc.page_count, get_page), doc.page_count, WORK_DPI, progress)
+        elif fmt == "pptx":
+            sizes = [doc.page_size(i) for i in range(doc.page_count)]
+            write_pptx(f, iter_pngs(doc.page_count, get_page), sizes, progress)
+        else:
+            raise ValueError(f"未知的匯出格式: {fmt}")
+    return out_path
+
+
+# --- 命令列批次處理 ---
+_worker = {}
+
+
+def _init_batch_worker(threads, cache_path):
+    _worker['threads'] = threads
+    _worker['engine'] = None
+    _worker['cache'] = OcrCache(cache_path) if cache_path else None
+
+
+def _worker_engine():
+    if _worker['engine'] is None:
+        _worker['engine'] = create_engine(_worker['threads'])
+    return _worker['engine']
+
+
+def process_document(task):
+    """處理一份文件 (在 worker 行程中執行)，回傳要寫進進度檔的紀錄。"""
+    start = time.perf_counter()
+    record = {"pdf": task['pdf'], "sha1": task['sha1']}
+    doc = load(task['pdf'])
+    try:
+        ocr_results = analyze(doc, get_engine=_worker_engine, cache=_worker['cache'])
+        stem = os.path.join(task['out_dir'], task.get('name') or _output_name(task['pdf']))
+        os.makedirs(os.path.dirname(stem), exist_ok=True)
+        with open(stem + ".ocr.json", "w", encoding="utf-8") as f:
+            json.dump({str(k): v.to_records() for k, v in ocr_results.items()}, f, ensure_ascii=False)
+
+        edits = list(task.get('edits', [])) + replace_rules_to_edits(ocr_results, task.get('replace', {}))
+        pages_data, edit_ops = apply_edits(doc, ocr_results, edits)
+        if edit_ops or task.get('always_export'):
+            out_path = stem + EXPORT_SUFFIX[task['format']]
+            export(doc, out_path, task['format'], pages_data, edit_ops)
+            record["out"] = out_path
+        record.update(status="ok", pages=doc.page_count, edits=sum(len(v) for v in edit_ops.values()))
+    finally:
+        doc.close()
+    record["seconds"] = round(time.perf_counter() - start, 2)
+    return record
+
+
+def _file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _output_name(pdf, root=None):
+    """輸出檔的相對路徑 (不含副檔名)：資料夾輸入保留相對於該資料夾的子目錄結構。"""
+    rel = os.path.relpath(pdf, root) if root else os.path.basename(pdf)
+    return os.path.splitext(rel)[0]
+
+
+def collect_tasks(inputs, manifest=None):
+    """
+    每個 task 的 name 是輸出檔相對於 --out 的路徑 (不含副檔名)。仍然重名的 (例如兩個輸入資料夾
+    各有一份 report.pdf) 加上來源路徑的雜湊，輸出檔不會互相覆蓋。
+    manifest 中無法解析或缺少 "pdf" 的行不會中斷整批，而是變成帶 error 的 task。
+    """
+    tasks = []
+    for item in inputs:
+        if os.path.isdir(item):
+            paths = sorted(glob.glob(os.path.join(item, "**", "*.pdf"), recursive=True))
+            tasks.extend({"pdf": p, "name": _output_name(p, item)} for p in paths)
+        else:
+            tasks.append({"pdf": item, "name": _output_name(item)})
+    if manifest:
+        with open(manifest, encoding="utf-8") as f:
+            for lineno, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    task = json.loads(line)
+                    if not isinstance(task, dict) or not isinstance(task.get('pdf'), str):
+                        raise ValueError('缺少 "pdf"')
+                except ValueError as e:
+                    task = {"pdf": f"{manifest}:{lineno}", "error": f"manifest 第 {lineno} 行無效: {e}"}
+                tasks.append(task)
+    names = {}
+    for task in tasks:
+        if 'error' in task:
+            continue
+        task.setdefault('name', _output_name(task['pdf']))
+        names.setdefault(os.path.normcase(task['name']), []).append(task)
+    for same in names.values():
+        if len(same) > 1:
+            for task in same:
+                digest = hashlib.sha1(os.path.abspath(task['pdf']).encode("utf-8")).hexdigest()[:8]
+                task['name'] = f"{task['name']}-{digest}"
+    return tasks
+
+
+def load_progress(path):
+    """已成功處理的 {pdf 路徑: sha1}。"""
+    done = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record.get("status") == "ok":
+                    done[record["pdf"]] = record["sha1"]
+    return done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批次 OCR 與文字取代")
+    parser.add_argument("inputs", nargs="*", help="PDF 檔案或資料夾")
+    parser.add_argument("--manifest", help="JSON lines，每行 {\"pdf\": ..., \"edits\": [...]}")
+    parser.add_argument("--out", required=True, help="輸出資料夾")
+    parser.add_argument("--format", choices=list(EXPORT_SUFFIX), default="vector")
+    parser.add_argument("--replace", action="append", default=[], metavar="OLD=NEW", help="文字取代規則，可重複")
+    parser.add_argument("--jobs", type=int, default=None, help="同時處理的文件數")
+    parser.add_argument("--progress", help="進度檔 (預設 <out>/progress.jsonl)")
+    parser.add_argument("--ocr-cache", default=OCR_CACHE_PATH, help="OCR 結果快取 (空字串表示不用)")
+    parser.add_argument("--always-export", action="store_true", help="沒有任何修改的文件也輸出")
+    args = parser.parse_args(argv)
+
+    rules = {}
+    for rule in args.replace:
+        old, sep, new = rule.partition("=")
+        if not sep or not old:
+            parser.error(f"--replace 格式應為 OLD=NEW: {rule}")
+        rules[old] = new
+
+    os.makedirs(args.out, exist_ok=True)
+    progress_path = args.progress or os.path.join(args.out, "progress.jsonl")
+    done = load_progress(progress_path)
+
+    tasks, errors = [], []
+    for task in collect_tasks(args.inputs, args.manifest):
+        if 'error' not in task:
+            try:
+                task['sha1'] = _file_sha1(task['pdf'])
+            except OSError as e:
+                task['error'] = f"{type(e).__name__}: {e}"
+        if 'error' in task:
+            # 讀不到的檔案、壞掉的 manifest 行只記錄為失敗，其他文件照常處理
+            errors.append({"pdf": task['pdf'], "sha1": task.get('sha1'), "status": "error", "error": task['error']})
+            continue
+        if done.get(task['pdf']) == task['sha1']:
+            continue
+        task.setdefault('replace', rules)
+        task.setdefault('format', args.format)
+        task.setdefault('out_dir', args.out)
+        task.setdefault('always_export', args.always_export)
+        tasks.append(task)
+    if errors:
+        with open(progress_path, "a", encoding="utf-8") as progress:
+            for record in errors:
+                progress.write(json.dumps(record, ensure_ascii=False) + "\n")
+                print(f"[-] error {record['pdf']}: {record['error']}")
+    if not tasks:
+        print("沒有需要處理的文件。")
+        return 1 if errors else 0
+
+    workers, threads = plan_workers(len(tasks), args.jobs)
+    print(f"處理 {len(tasks)} 份文件 (已完成 {len(done)} 份)，{workers} 個 worker × {threads} 執行緒")
+    failed = len(errors)
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=mp.get_context("spawn"),
+        initializer=_init_batch_worker,
+        initargs=(threads, args.ocr_cache or None),
+    ) as executor, open(progress_path, "a", encoding="utf-8") as progress:
+        futures = {executor.submit(process_document, task): task for task in tasks}
+        for n, future in enumerate(as_completed(futures), 1):
+            task = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                failed += 1
+                record = {"pdf": task['pdf'], "sha1": task['sha1'], "status": "error", "error": repr(e)}
+            progress.write(json.dumps(record, ensure_ascii=False) + "\n")
+            progress.flush()
+            print(f"[{n}/{len(tasks)}] {record['status']:5} {task['pdf']}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
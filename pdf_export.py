@@ -0,0 +1,459 @@
+"""
+匯出。
+
+向量模式 (export_vector_pdf)：以 pikepdf 直接修改原始 PDF，沒修改過的頁面原封不動，
+修改過的頁面只在原本的向量內容上疊一個白色矩形與真正的文字物件，
+所以檔案大小與匯出時間只跟修改數量有關，文字也仍然可以搜尋、複製。
+
+點陣模式 (write_image_pdf / write_pptx)：依頁序消費已編碼好的 PNG，直接串流到暫存檔，
+記憶體用量與頁數無關。ExportJob 在背景執行緒中跑整個匯出，
+渲染與 PNG 編碼分散到 process pool，再依頁序組裝。
+"""
+import io
+import multiprocessing as mp
+import os
+import struct
+import tempfile
+import threading
+import weakref
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pikepdf
+from PIL import Image, ImageDraw
+from pptx import Presentation
+from pptx.util import Inches
+
+from pdf_edit import FONTS, encode_png
+from pdf_metrics import METRICS
+from pdf_render import open_renderer
+
+SLIDE_WIDTH = Inches(13.333)
+SLIDE_HEIGHT = Inches(7.5)
+
+# 中文字使用 Adobe-CNS1 的標準 CID 字型 (不嵌入，由閱讀器提供對應字型)，
+# 文字以 UTF-16BE 搭配 UniCNS-UTF16-H CMap 編碼。
+CJK_FONT_NAME = "MSung-Light"
+CJK_ENCODING = "UniCNS-UTF16-H"
+
+
+def _cjk_font(pdf):
+    descriptor = pikepdf.Dictionary(
+        Type=pikepdf.Name.FontDescriptor,
+        FontName=pikepdf.Name("/" + CJK_FONT_NAME),
+        Flags=6,
+        FontBBox=[-160, -249, 1015, 888],
+        ItalicAngle=0,
+        Ascent=880,
+        Descent=-120,
+        CapHeight=880,
+        StemV=93,
+    )
+    cid_font = pikepdf.Dictionary(
+        Type=pikepdf.Name.Font,
+        Subtype=pikepdf.Name.CIDFontType0,
+        BaseFont=pikepdf.Name("/" + CJK_FONT_NAME),
+        CIDSystemInfo=pikepdf.Dictionary(Registry=pikepdf.String("Adobe"), Ordering=pikepdf.String("CNS1"), Supplement=0),
+        FontDescriptor=pdf.make_indirect(descriptor),
+        DW=1000,
+        W=[1, 95, 500],  # CID 1–95 是半形英數
+    )
+    return pdf.make_indirect(pikepdf.Dictionary(
+        Type=pikepdf.Name.Font,
+        Subtype=pikepdf.Name.Type0,
+        BaseFont=pikepdf.Name("/" + CJK_FONT_NAME + "-" + CJK_ENCODING),
+        Encoding=pikepdf.Name("/" + CJK_ENCODING),
+        DescendantFonts=[pdf.make_indirect(cid_font)],
+    ))
+
+
+def pixel_to_user_matrix(page, dpi):
+    """
+    回傳 cm 矩陣，把「渲染後圖片的像素座標 (左上原點、y 向下)」對應到頁面的使用者座標，
+    已考慮 CropBox 位移與 /Rotate。
+    """
+    x0, y0, x1, y1 = [float(v) for v in page.cropbox]
+    x0, x1 = min(x0, x1), max(x0, x1)
+    y0, y1 = min(y0, y1), max(y0, y1)
+    s = 72 / dpi
+    rotate = int(page.obj.get("/Rotate", 0)) % 360
+    if rotate == 90:
+        return (0, s, s, 0, x0, y0)
+    if rotate == 180:
+        return (-s, 0, 0, s, x1, y0)
+    if rotate == 270:
+        return (0, -s, -s, 0, x1, y1)
+    return (s, 0, 0, -s, x0, y1)
+
+
+def _line_metrics(font_size, stroke_width):
+    """與 ImageDraw.multiline_text 相同的基線位置與行距，讓向量輸出對齊點陣預覽。"""
+    path, weight, stroke_width = FONTS.face(stroke_width)
+    font = FONTS.font(font_size, path, weight)
+    if getattr(font, "size", None) != font_size:
+        # 找不到字型檔時會退回預設字型，只能用比例估算
+        return font_size * 0.88, font_size + stroke_width + 4
+    draw = ImageDraw.Draw(Image.new("L", (1, 1)))
+    ascent = font.getmetrics()[0]
+    spacing = draw.textbbox((0, 0), "A", font=font, stroke_width=stroke_width)[3] + stroke_width + 4
+    return ascent, spacing
+
+
+def _hex_color(color):
+    color = color.lstrip("#")
+    return [int(color[i:i + 2], 16) / 255 for i in (0, 2, 4)]
+
+
+def _fmt(*values):
+    return " ".join(f"{v:.4f}".rstrip("0").rstrip(".") if isinstance(v, float) else str(v) for v in values)
+
+
+def text_edit_content(op, font_name):
+    """一筆文字修改 → 內容串流 (像素座標系，外層已套用 pixel_to_user_matrix)。"""
+    ex0, ey0, ex1, ey1 = [float(v) for v in op['erase']]
+    size = float(op['font_size'])
+    stroke = float(op.get('stroke_width', 0))
+    r, g, b = _hex_color(op.get('color', "#000000"))
+    ascent, spacing = _line_metrics(int(size), int(stroke))
+
+    parts = [
+        "1 1 1 rg",
+        f"{_fmt(ex0, ey0, ex1 - ex0, ey1 - ey0)} re f",
+        f"{_fmt(r, g, b)} rg {_fmt(r, g, b)} RG",
+        "BT",
+        f"{font_name} 1 Tf",
+    ]
+    if stroke:
+        parts.append(f"2 Tr {_fmt(stroke * 2 / size)} w")
+    for i, line in enumerate(op['text'].split("\n")):
+        baseline = float(op['y']) + ascent + i * spacing
+        # y 軸在像素座標系裡向下，所以 Tm 的 d 要取負值讓字是正的
+        parts.append(f"{_fmt(size, 0, 0, -size, float(op['x']), baseline)} Tm")
+        parts.append(f"<{line.encode('utf-16-be').hex()}> Tj")
+    parts.append("ET")
+    return "\n".join(parts)
+
+
+def export_vector_pdf(data, page_edits, dpi, out=None):
+    """
+    data: 原始 PDF bytes；page_edits: {頁碼: [修改, ...]} (修改的座標為 dpi 下的像素)。
+    out 為可寫入的檔案物件；未提供時回傳 bytes。
+    """
+    with METRICS.span("export.vector"):
+        return _export_vector_pdf(data, page_edits, dpi, out)
+
+
+def _export_vector_pdf(data, page_edits, dpi, out):
+    pdf = pikepdf.open(io.BytesIO(data))
+    font = None
+    for page_idx, ops in sorted(page_edits.items()):
+        if not ops:
+            continue
+        if font is None:
+            font = _cjk_font(pdf)
+        page = pdf.pages[page_idx]
+        font_name = page.add_resource(font, pikepdf.Name.Font, prefix="OcrEdit")
+        matrix = pixel_to_user_matrix(page, dpi)
+        body = "\n".join(text_edit_content(op, font_name) for op in ops)
+        # 先把原本的內容包在 q/Q 裡，避免它殘留的繪圖狀態影響疊上去的內容
+        page.contents_add(pdf.make_stream(b"q\n"), prepend=True)
+        page.contents_add(pdf.make_stream(f"\nQ\nq\n{_fmt(*matrix)} cm\n{body}\nQ\n".encode("ascii")))
+
+    if out is None:
+        buf = io.BytesIO()
+        pdf.save(buf)
+        return buf.getvalue()
+    pdf.save(out)
+    return out
+
+
+# --- 點陣匯出 (串流) ---
+def _png_size(png):
+    return struct.unpack(">II", png[16:24])
+
+
+def _png_idat(png):
+    """取出 PNG 的 IDAT 資料，可直接以 FlateDecode + PNG predictor 放進 PDF，不必重新壓縮。"""
+    pos = 8
+    chunks = []
+    while pos < len(png):
+        length, chunk_type = struct.unpack(">I4s", png[pos:pos + 8])
+        if chunk_type == b"IDAT":
+            chunks.append(png[pos + 8:pos + 8 + length])
+        pos += 12 + length
+    return b"".join(chunks)
+
+
+class _PdfStreamWriter:
+    """依序寫出 PDF 物件並記錄位移，最後補上 xref；寫過的內容不會留在記憶體。"""
+
+    def __init__(self, out):
+        self.out = out
+        self.pos = 0
+        self.offsets = {}
+        self._write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+    def _write(self, data):
+        self.out.write(data)
+        self.pos += len(data)
+
+    def obj(self, num, body, stream=None):
+        self.offsets[num] = self.pos
+        self._write(f"{num} 0 obj\n".encode())
+        if stream is None:
+            self._write(body.encode() + b"\nendobj\n")
+        else:
+            self._write(body[:-2].encode() + f" /Length {len(stream)} >>\nstream\n".encode())
+            self._write(stream)
+            self._write(b"\nendstream\nendobj\n")
+
+    def close(self, root):
+        size = max(self.offsets) + 1
+        xref = self.pos
+        lines = [f"xref\n0 {size}\n", "0000000000 65535 f \n"]
+        for num in range(1, size):
+            lines.append(f"{self.offsets[num]:010d} 00000 n \n" if num in self.offsets else "0000000000 65535 f \n")
+        lines.append(f"trailer\n<< /Size {size} /Root {root} 0 R >>\nstartxref\n{xref}\n%%EOF\n")
+        self._write("".join(lines).encode())
+
+
+def iter_pngs(page_count, get_page):
+    """依序渲染並編碼每一頁 (單執行緒版本)。get_page(i) 回傳第 i 頁的 RGB 圖片。"""
+    for i in range(page_count):
+        yield encode_png(get_page(i))
+
+
+def write_image_pdf(out, pngs, page_count, dpi, progress=None):
+    """
+    每頁一張圖片的 PDF。pngs 依頁序提供每頁的 RGB PNG，頁面尺寸依 dpi 換算回原本的點數。
+    物件編號：1 Catalog、2 Pages，第 i 頁依序為圖片、內容串流、Page 三個物件。
+    """
+    writer = _PdfStreamWriter(out)
+    kids = []
+    for i, png in enumerate(pngs):
+        w, h = _png_size(png)
+        idat = _png_idat(png)
+        del png
+        pw, ph = w * 72 / dpi, h * 72 / dpi
+        img_num, content_num, page_num = 3 + 3 * i, 4 + 3 * i, 5 + 3 * i
+        writer.obj(img_num, (
+            f"<< /Type /XObject /Subtype /Image /Width {w} /Height {h} /ColorSpace /DeviceRGB "
+            f"/BitsPerComponent 8 /Filter /FlateDecode "
+            f"/DecodeParms << /Predictor 15 /Colors 3 /BitsPerComponent 8 /Columns {w} >> >>"
+        ), idat)
+        writer.obj(content_num, "<< >>", f"q {pw:.2f} 0 0 {ph:.2f} 0 0 cm /Im0 Do Q".encode())
+        writer.obj(page_num, (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {pw:.2f} {ph:.2f}] "
+            f"/Resources << /XObject << /Im0 {img_num} 0 R >> >> /Contents {content_num} 0 R >>"
+        ))
+        kids.append(f"{page_num} 0 R")
+        if progress: progress(i + 1, page_count)
+    writer.obj(2, f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {page_count} >>")
+    writer.obj(1, "<< /Type /Catalog /Pages 2 0 R >>")
+    writer.close(root=1)
+
+
+def _placeholder_png(i):
+    # python-pptx 會依 SHA1 合併相同的圖片，所以每頁的佔位圖顏色都不同
+    return io.BytesIO(encode_png(Image.new("RGB", (1, 1), (i >> 16 & 255, i >> 8 & 255, i & 255))))
+
+
+def write_pptx(out, pngs, page_sizes, progress=None):
+    """
+    python-pptx 會把所有圖片留在記憶體裡，所以先用 1x1 的佔位圖建好簡報骨架，
+    再依頁序把 ppt/media 中的佔位圖換成 pngs 提供的真正頁面圖片。
+    page_sizes 是每頁的 (寬, 高)，只用來決定投影片上圖片的比例。
+    """
+    page_count = len(page_sizes)
+    prs = Presentation()
+    prs.slide_width = SLIDE_WIDTH
+    prs.slide_height = SLIDE_HEIGHT
+    media = [None] * page_count
+    for i, (w, h) in enumerate(page_sizes):
+        slide = prs.slides.add_slide(prs.slide_layouts[6])
+        pic = slide.shapes.add_picture(_placeholder_png(i), 0, 0, width=SLIDE_WIDTH, height=int(SLIDE_WIDTH * h / w))
+        media[i] = slide.part.related_part(pic._pic.blip_rId).partname.lstrip("/")
+    skeleton = io.BytesIO()
+    prs.save(skeleton)
+    del prs
+
+    placeholders = set(media)
+    with zipfile.ZipFile(skeleton) as zin, zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zout:
+        for item in zin.infolist():
+            if item.filename not in placeholders:
+                zout.writestr(item, zin.read(item.filename))
+        for i, png in enumerate(pngs):
+            zout.writestr(media[i], png, compress_type=zipfile.ZIP_STORED)
+            if progress: progress(i + 1, page_count)
+
+
+def export_to_tempfile(write, suffix):
+    """write(f) 寫入暫存檔後回傳路徑；呼叫端用完要自行刪除。"""
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+# --- 背景匯出 ---
+_worker = {}
+
+
+def _init_export_worker(data, dpi, backend):
+    _worker['renderer'] = open_renderer(data, backend)
+    _worker['dpi'] = dpi
+
+
+def _encode_page(page_idx, raw=None):
+    """raw 為 (mode, size, bytes) 時表示已修改的頁面，否則由 worker 自己渲染原始頁面。"""
+    if raw is not None:
+        img = Image.frombytes(*raw)
+    else:
+        img = _worker['renderer'].render(page_idx, _worker['dpi'])
+    return encode_png(img)
+
+
+def _remove_files(paths):
+    for path in list(paths):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    paths.clear()
+
+
+class ExportFiles(dict):
+    """
+    {格式: (編輯狀態鍵, 暫存檔路徑)}：已完成的匯出檔。
+    同一格式換成新檔時刪除舊檔；物件被回收 (session 結束) 時刪除剩下的暫存檔。
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._paths = set()
+        weakref.finalize(self, _remove_files, self._paths)
+
+    def __setitem__(self, fmt, value):
+        old = self.get(fmt)
+        if old and old[1] != value[1]:
+            _remove_files({old[1]})
+            self._paths.discard(old[1])
+        self._paths.add(value[1])
+        super().__setitem__(fmt, value)
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+class ExportJob:
+    """
+    在背景執行緒中匯出整份文件，完成後 path 指向暫存檔。
+
+    fmt: "pdf" / "pptx" / "vector"；edited: {頁碼: 修改後的 RGB 圖片}；
+    edit_ops: {頁碼: [修改, ...]} (只有 vector 用得到)。
+    建立時會複製 edited / edit_ops，之後繼續編輯不會影響這次匯出；edited 有 snapshot()
+    (伺服器模式的 PageStore) 時改用磁碟上的快照，不必把所有已修改的頁面讀進記憶體。
+    同時在處理中的頁面最多 window 頁，記憶體用量不隨頁數增加。
+    """
+
+    SUFFIX = {"pdf": ".pdf", "pptx": ".pptx", "vector": ".pdf"}
+
+    def __init__(self, fmt, data, page_sizes, dpi, edited=None, edit_ops=None,
+                 workers=None, backend=None, window=None):
+        self.fmt = fmt
+        self.data = data
+        self.page_sizes = list(page_sizes)
+        self.total = len(self.page_sizes)
+        self.dpi = dpi
+        if hasattr(edited, "snapshot"):
+            self.edited = edited.snapshot()
+        else:
+            self.edited = {i: img.copy() for i, img in (edited or {}).items()}
+        self.edit_ops = {i: list(ops) for i, ops in (edit_ops or {}).items()}
+        self.workers = max(1, min(workers or os.cpu_count() or 1, self.total))
+        self.backend = backend
+        self.window = window or self.workers * 2
+        self.completed = 0
+        self.path = None
+        self.error = None
+        self._cancel = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def done(self):
+        return not self._thread.is_alive()
+
+    @property
+    def progress(self):
+        return self.completed / self.total if self.total else 1.0
+
+    def cancel(self):
+        self._cancel.set()
+
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+        return self.path
+
+    def _report(self, done, total):
+        self.completed = done
+        if self._cancel.is_set():
+            raise ExportCancelled()
+
+    def _run(self):
+        try:
+            with METRICS.span("export", fmt=self.fmt, pages=self.total):
+                self.path = export_to_tempfile(self._write, self.SUFFIX[self.fmt])
+        except ExportCancelled:
+            pass
+        except Exception as e:
+            self.error = e
+        finally:
+            if hasattr(self.edited, "close"):
+                self.edited.close()
+
+    def _write(self, out):
+        if self.fmt == "vector":
+            export_vector_pdf(self.data, self.edit_ops, self.dpi, out)
+            self._report(self.total, self.total)
+            return
+        with ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_export_worker,
+            initargs=(self.data, self.dpi, self.backend),
+        ) as executor:
+            pngs = self._iter_pngs(executor)
+            try:
+                if self.fmt == "pdf":
+                    write_image_pdf(out, pngs, self.total, self.dpi, self._report)
+                else:
+                    write_pptx(out, pngs, self.page_sizes, self._report)
+            finally:
+                pngs.close()
+                executor.shutdown(cancel_futures=True)
+
+    def _submit(self, executor, i):
+        img = self.edited.get(i)
+        raw = (img.mode, img.size, img.tobytes()) if img is not None else None
+        return executor.submit(_encode_page, i, raw)
+
+    def _iter_pngs(self, executor):
+        # 保持最多 window 頁在處理中，依頁序取回結果
+        pending = deque()
+        next_page = 0
+        while next_page < self.total and len(pending) < self.window:
+            pending.append(self._submit(executor, next_page))
+            next_page += 1
+        while pending:
+            png = pending.popleft().result()
+            if next_page < self.total:
+                pending.append(self._submit(executor, next_page))
+                next_page += 1
+            yield png
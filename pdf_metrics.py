@@ -0,0 +1,185 @@
+"""
+效能量測：各階段的耗時 (span)、記憶體高水位與 session 大小。
+
+    with METRICS.span("render", page=3, dpi=150):
+        ...
+    METRICS.record("ocr.det", elapse[0], page=3)
+
+每個行程各有一份 METRICS (批次 OCR / 匯出的 worker 行程各自記錄，不會彙整回主程式)。
+可以輸出成 JSON (to_json) 或 Prometheus 文字格式 (to_prometheus)。
+"""
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+RECENT_SPANS = 500  # 保留最近幾筆 span 的明細
+
+
+def _proc_status_bytes(field):
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_bytes():
+    """
+    RSS 高水位。Linux 讀 /proc 的 VmHWM，可以用 reset_peak_rss() 歸零後分段量測；
+    其他平台是行程啟動以來的 ru_maxrss。
+    """
+    peak = _proc_status_bytes("VmHWM")
+    if peak is not None:
+        return peak
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 回傳 KB，macOS 回傳 bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def reset_peak_rss():
+    """把高水位重設成目前的 RSS (Linux 4.0+)；不支援時回傳 False，高水位維持整個行程的值。"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def current_rss_bytes():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * 4096
+    except OSError:
+        return None
+
+
+def estimate_size(obj, _seen=None):
+    """
+    粗估物件佔用的記憶體 (bytes)：圖片以像素計、NumPy 陣列與有 nbytes 的物件 (例如 EditHistory)
+    直接取 nbytes，其餘容器與本專案的物件遞迴加總。
+    """
+    seen = set() if _seen is None else _seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, Image.Image):
+        return obj.width * obj.height * len(obj.getbands())
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(getattr(obj, "nbytes", None), int):
+        return obj.nbytes
+    size = sys.getsizeof(obj, 0)
+    if isinstance(obj, dict):
+        size += sum(estimate_size(k, seen) + estimate_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(estimate_size(v, seen) for v in obj)
+    elif type(obj).__module__.startswith("pdf_"):
+        # 只展開這個專案自己的物件，執行緒、行程池之類的外部物件不追下去
+        if hasattr(obj, "__dict__"):
+            size += estimate_size(vars(obj), seen)
+        for k in getattr(type(obj), "__slots__", ()):
+            if hasattr(obj, k):
+                size += estimate_size(getattr(obj, k), seen)
+    return size
+
+
+class Metrics:
+    def __init__(self, recent=RECENT_SPANS):
+        self.stages = {}    # stage → {"count", "seconds", "max"}
+        self.counters = {}
+        self.gauges = {}
+        self.spans = deque(maxlen=recent)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage, page=None, dpi=None, **attrs):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, page, dpi, **attrs)
+
+    def record(self, stage, seconds, page=None, dpi=None, **attrs):
+        span = {"stage": stage, "seconds": seconds, "time": time.time()}
+        if page is not None: span["page"] = page
+        if dpi is not None: span["dpi"] = dpi
+        span.update(attrs)
+        with self._lock:
+            stat = self.stages.setdefault(stage, {"count": 0, "seconds": 0.0, "max": 0.0})
+            stat["count"] += 1
+            stat["seconds"] += seconds
+            stat["max"] = max(stat["max"], seconds)
+            self.spans.append(span)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+            self.counters.clear()
+            self.gauges.clear()
+            self.spans.clear()
+
+    def to_json(self):
+        with self._lock:
+            return {
+                "stages": {k: dict(v) for k, v in self.stages.items()},
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "memory": {"rss_bytes": current_rss_bytes(), "peak_rss_bytes": peak_rss_bytes()},
+                "spans": list(self.spans),
+            }
+
+    def to_prometheus(self, prefix="pdf_tool"):
+        data = self.to_json()
+        lines = [
+            f"# TYPE {prefix}_stage_seconds_total counter",
+            f"# TYPE {prefix}_stage_calls_total counter",
+            f"# TYPE {prefix}_stage_seconds_max gauge",
+        ]
+        for stage, stat in sorted(data["stages"].items()):
+            label = f'{{stage="{stage}"}}'
+            lines.append(f"{prefix}_stage_seconds_total{label} {stat['seconds']:.6f}")
+            lines.append(f"{prefix}_stage_calls_total{label} {stat['count']}")
+            lines.append(f"{prefix}_stage_seconds_max{label} {stat['max']:.6f}")
+        for name, value in sorted(data["counters"].items()):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value}")
+        for name, value in sorted({**data["gauges"], **data["memory"]}.items()):
+            if value is None:
+                continue
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
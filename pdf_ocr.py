@@ -0,0 +1,709 @@
+"""
+OCR：RapidOCR 結果整理，以及整份文件的批次分析。
+
+批次分析使用 process pool，每個 worker 只載入一次 PDF 與一個 ONNX session，
+主程式 (Streamlit) 這邊透過 BatchOcrJob 輪詢進度、取回結果或取消。
+OCR 結果依「頁面點陣圖雜湊 + OCR 參數」存進磁碟上的 OcrCache，重複的頁面不必再推論。
+有文字層的頁面 (原生數位 PDF) 直接從 pdfplumber 取文字與字體大小，只對圖片區域做 OCR。
+"""
+import difflib
+import hashlib
+import io
+import json
+import multiprocessing as mp
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pdfplumber
+import shapely
+from PIL import Image
+
+from pdf_metrics import METRICS
+from pdf_render import open_renderer
+
+# RapidOCR 參數 (也會成為 OCR 結果快取鍵的一部分)
+OCR_SETTINGS = {"det_db_unclip_ratio": 1.3}
+
+OCR_CACHE_PATH = os.environ.get("PDF_TOOL_OCR_CACHE", os.path.join(".cache", "ocr_cache.sqlite3"))
+OCR_CACHE_MAX_BYTES = int(os.environ.get("PDF_TOOL_OCR_CACHE_MB", "512")) * 1024 * 1024
+
+# 分析模式："auto" 先用 PDF 文字層，沒有可用文字層的頁面 / 圖片區域才跑 OCR；"ocr" 一律 OCR
+ANALYSIS_MODE = os.environ.get("PDF_TOOL_ANALYSIS", "auto")
+TEXT_LAYER_MIN_CHARS = 3       # 少於這麼多可見字元就當作沒有文字層
+TEXT_LAYER_MAX_CID_RATIO = 0.1  # 無法對應到 Unicode 的 (cid:N) 字元超過這個比例就不採用
+IMAGE_REGION_MIN_PX = 48       # 小於這個邊長 (像素) 的圖片不做 OCR
+TEXT_LINE_Y_TOLERANCE = 3      # 字詞的 top 相差不超過這麼多點就算同一行
+TEXT_BOX_GAP_EM = 1.0          # 同一行裡水平間距超過「字級 × 這個倍數」就分成不同的框 (分欄、表格、文字框)
+
+# 大頁面分塊 OCR：RapidOCR 會把長邊超過 2000 (它的 max_side_len) 的圖悄悄縮小，所以超過
+# OCR_TILE_THRESHOLD 就切成互相重疊的 OCR_TILE_SIZE 方塊各自辨識；重疊寬度要大於最高的一行字。總像素超過 OCR_MAX_PIXELS 先整張縮小，
+# 讓方塊數 (也就是延遲與記憶體) 有上限。OCR_TILE_WORKERS > 1 時方塊平行辨識 (每個執行緒一個模型)，
+# 但只在呼叫者傳入 parallel_tiles=True 時；引擎池 (pdf_server) 與批次 worker 已經自己分配好核心，一律逐塊用它們給的引擎。
+OCR_TILE_THRESHOLD = 2000
+OCR_TILE_SIZE = int(os.environ.get("PDF_TOOL_OCR_TILE", "1600"))
+OCR_TILE_OVERLAP = int(os.environ.get("PDF_TOOL_OCR_TILE_OVERLAP", "200"))
+OCR_MAX_PIXELS = int(float(os.environ.get("PDF_TOOL_OCR_MAX_MPX", "40")) * 1_000_000)
+OCR_TILE_WORKERS = int(os.environ.get("PDF_TOOL_OCR_TILE_WORKERS", "1"))
+TILE_DEDUP_OVERLAP = 0.5       # 兩個框的交集佔較小框面積超過這個比例，可能是同一段字
+TILE_DEDUP_TEXT = 0.8          # ……而且較短的文字有這個比例的字元出現在另一段裡，才當成重複
+TILE_CUT_TOLERANCE_EM = 0.5    # 框的邊緣離方塊接縫不到「行高 × 這個倍數」就當成被切到 (RapidOCR 的框常比字的邊緣內縮幾個像素)
+
+
+def create_engine(threads=None):
+    from rapidocr_onnxruntime import RapidOCR
+    kwargs = dict(OCR_SETTINGS)
+    if threads:
+        kwargs["intra_op_num_threads"] = threads
+    return RapidOCR(**kwargs)
+
+
+def calc_font_styles(heights):
+    """
+    依框高推估字體大小與筆畫粗細 (整欄一起算)，回傳 (font_size, stroke_width) 兩個陣列。
+    字體 = max(10, int(框高 * 0.9))；超過 50 的筆畫加粗 2，其餘為 0。
+    """
+    font_size = np.maximum(10, (np.asarray(heights, dtype=np.float64) * 0.9).astype(np.int32))
+    stroke = np.where(font_size > 50, 2, 0).astype(np.int32)
+    return font_size, stroke
+
+
+# --- OCR 結果 (欄式) ---
+# 每頁的 OCR 結果以 NumPy 陣列逐欄存放，框的正規化、字體重算、畫布縮放與
+# 拖曳比對都是整欄運算；密集的頁面 (試算表、掃描表單) 動輒數千個框也不必逐框跑 Python。
+# 需要單一框時，boxes[i] 回傳可讀寫的 OcrBox，用法跟原本的 dict 一樣。
+COORD_KEYS = ('x0', 'top', 'x1', 'bottom')
+ORIG_KEYS = ('orig_x0', 'orig_top', 'orig_x1', 'orig_bottom')
+
+
+class OcrBox:
+    __slots__ = ("_boxes", "_i")
+
+    def __init__(self, boxes, i):
+        self._boxes = boxes
+        self._i = i
+
+    def __contains__(self, key):
+        return key in OcrBoxes.FIELDS
+
+    def __getitem__(self, key):
+        b, i = self._boxes, self._i
+        if key in COORD_KEYS:
+            return b.coords[i, COORD_KEYS.index(key)].item()
+        if key in ORIG_KEYS:
+            return b.orig[i, ORIG_KEYS.index(key)].item()
+        if key == 'text':
+            return b.text[i]
+        if key in ('font_size', 'stroke_width', 'color'):
+            return getattr(b, key)[i].item()
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        b, i = self._boxes, self._i
+        if key in COORD_KEYS:
+            b.coords[i, COORD_KEYS.index(key)] = value
+        elif key in ORIG_KEYS:
+            b.orig[i, ORIG_KEYS.index(key)] = value
+        elif key == 'text':
+            b.text[i] = value
+        elif key in ('font_size', 'stroke_width', 'color'):
+            getattr(b, key)[i] = value
+        else:
+            raise KeyError(key)
+
+    def to_dict(self):
+        return {key: self[key] for key in OcrBoxes.FIELDS}
+
+
+class OcrBoxes:
+    FIELDS = COORD_KEYS + ORIG_KEYS + ('text', 'font_size', 'stroke_width', 'color')
+
+    def __init__(self, coords, text, orig=None, font_size=None, stroke_width=None, color=None):
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 4)
+        self.orig = self.coords.copy() if orig is None else np.asarray(orig, dtype=np.float64).reshape(-1, 4)
+        self.text = list(text)
+        if font_size is None or stroke_width is None:
+            font_size, stroke_width = calc_font_styles(self.heights)
+        self.font_size = np.asarray(font_size, dtype=np.int32)
+        self.stroke_width = np.asarray(stroke_width, dtype=np.int32)
+        if color is None:
+            color = ["#000000"] * len(self.text)
+        self.color = np.asarray(color, dtype="U16")
+
+    @classmethod
+    def from_ocr(cls, result):
+        """RapidOCR 的 [(四角座標, 文字, 信心值), ...] → 外接矩形 (座標先截成整數，同原本的 int())。"""
+        if not result:
+            return cls(np.empty((0, 4)), [])
+        quads = np.array([item[0] for item in result], dtype=np.float64).astype(np.int64)
+        xs, ys = quads[:, :, 0], quads[:, :, 1]
+        coords = np.column_stack([xs.min(1), ys.min(1), xs.max(1), ys.max(1)])
+        return cls(coords, [item[1] for item in result])
+
+    @classmethod
+    def from_records(cls, records):
+        """舊格式 (dict 清單)，例如 OCR 快取與 .ocr.json 的內容。"""
+        if not records:
+            return cls(np.empty((0, 4)), [])
+        coords = [[r[k] for k in COORD_KEYS] for r in records]
+        orig = [[r.get(o, r[k]) for o, k in zip(ORIG_KEYS, COORD_KEYS)] for r in records]
+        return cls(
+            coords, [r['text'] for r in records], orig,
+            [r.get('font_size', 30) for r in records],
+            [r.get('stroke_width', 1) for r in records],
+            [r.get('color', "#000000") for r in records],
+        )
+
+    @classmethod
+    def concat(cls, parts):
+        parts = [p for p in parts if len(p)]
+        if not parts:
+            return cls(np.empty((0, 4)), [])
+        return cls(
+            np.vstack([p.coords for p in parts]), [t for p in parts for t in p.text],
+            np.vstack([p.orig for p in parts]),
+            np.concatenate([p.font_size for p in parts]),
+            np.concatenate([p.stroke_width for p in parts]),
+            np.concatenate([p.color for p in parts]),
+        )
+
+    def take(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        return OcrBoxes(
+            self.coords[indices], [self.text[i] for i in indices.tolist()], self.orig[indices],
+            self.font_size[indices], self.stroke_width[indices], self.color[indices],
+        )
+
+    def translate(self, dx, dy):
+        offset = np.array([dx, dy, dx, dy], dtype=np.float64)
+        self.coords += offset
+        self.orig += offset
+        return self
+
+    def to_records(self):
+        return [box.to_dict() for box in self]
+
+    def __len__(self):
+        return len(self.text)
+
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        return OcrBox(self, i % len(self))
+
+    def __iter__(self):
+        return (OcrBox(self, i) for i in range(len(self)))
+
+    @property
+    def heights(self):
+        return self.coords[:, 3] - self.coords[:, 1]
+
+    def recompute_fonts(self):
+        """依目前框高重新推估所有框的字體大小與筆畫。"""
+        self.font_size, self.stroke_width = calc_font_styles(self.heights)
+
+    def scaled_rects(self, scale):
+        """畫布用的 (left, top, width, height)，已乘上顯示縮放比例。"""
+        x0, top, x1, bottom = self.coords.T
+        return np.column_stack([x0, top, x1 - x0, bottom - top]) * scale
+
+    def update_from_rects(self, rects, scale, tolerance=1):
+        """
+        rects 是畫布回傳的 (left, top, width, height)，換算回頁面座標後
+        與目前的框比對，任一邊移動超過 tolerance 像素就更新；回傳有變動的索引。
+        """
+        rects = np.asarray(rects, dtype=np.float64).reshape(-1, 4) / scale
+        new = np.column_stack([rects[:, 0], rects[:, 1], rects[:, 0] + rects[:, 2], rects[:, 1] + rects[:, 3]])
+        changed = np.flatnonzero((np.abs(new - self.coords) > tolerance).any(axis=1))
+        self.coords[changed] = new[changed]
+        return changed
+
+
+# --- OCR 結果快取 ---
+def ocr_cache_key(img):
+    h = hashlib.sha1()
+    h.update(f"{img.mode}:{img.width}x{img.height}:".encode())
+    h.update(json.dumps(OCR_SETTINGS, sort_keys=True).encode())
+    if needs_tiling(img.size):
+        h.update(f"tile:{OCR_TILE_SIZE}:{OCR_TILE_OVERLAP}:{OCR_MAX_PIXELS}:".encode())
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+
+class OcrCache:
+    """
+    SQLite 檔案快取：key → zlib 壓縮的 OCR 結果 JSON (OcrBoxes.to_records())。
+    總大小超過 max_bytes 時，依最後使用時間淘汰最舊的項目。
+    每次操作都開新連線，所以可以同時被多個執行緒 / worker 行程使用。
+    """
+
+    def __init__(self, path=OCR_CACHE_PATH, max_bytes=OCR_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ocr ("
+                "key TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ocr_last_used ON ocr (last_used)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute("SELECT data FROM ocr WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE ocr SET last_used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, key, records):
+        data = zlib.compress(json.dumps(records, ensure_ascii=False, separators=(",", ":")).encode())
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO ocr (key, data, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, data, len(data), time.time()),
+            )
+            self._evict(conn)
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM ocr").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        stale = []
+        for key, size in conn.execute("SELECT key, size FROM ocr ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM ocr WHERE key = ?", stale)
+
+
+# --- 大頁面分塊 OCR ---
+def needs_tiling(size):
+    return max(size) > OCR_TILE_THRESHOLD or size[0] * size[1] > OCR_MAX_PIXELS
+
+
+def tile_grid(size, tile=None, overlap=None):
+    """覆蓋整張圖、彼此重疊 overlap 像素的方塊 [(x0, y0, x1, y1), ...]；最後一塊貼齊右 / 下緣。"""
+    tile = tile or OCR_TILE_SIZE
+    overlap = OCR_TILE_OVERLAP if overlap is None else overlap
+    step = max(1, tile - overlap)
+
+    def starts(length):
+        if length <= tile:
+            return [0]
+        points = list(range(0, length - tile, step))
+        return points + [length - tile]
+
+    width, height = size
+    return [(x, y, min(x + tile, width), min(y + tile, height))
+            for y in starts(height) for x in starts(width)]
+
+
+_tile_local = threading.local()
+_tile_executor = None
+_tile_executor_lock = threading.Lock()
+
+
+def _thread_engine():
+    # RapidOCR 的偵測器會在呼叫時改寫自己的前處理設定，不能跨執行緒共用同一個實例
+    if getattr(_tile_local, "engine", None) is None:
+        threads = max(1, (os.cpu_count() or 1) // OCR_TILE_WORKERS)
+        _tile_local.engine = create_engine(threads)
+    return _tile_local.engine
+
+
+def _get_tile_executor():
+    global _tile_executor
+    with _tile_executor_lock:
+        if _tile_executor is None:
+            _tile_executor = ThreadPoolExecutor(max_workers=OCR_TILE_WORKERS, thread_name_prefix="ocr-tile")
+        return _tile_executor
+
+
+def _record_elapse(elapse):
+    # RapidOCR 回傳的 elapse 是 [偵測, 方向分類, 辨識] 各自的秒數 (沒有偵測到文字時為 None)
+    if isinstance(elapse, (list, tuple)) and len(elapse) == 3:
+        for stage, seconds in zip(("ocr.det", "ocr.cls", "ocr.rec"), elapse):
+            METRICS.record(stage, seconds)
+
+
+def _ocr_tile(engine, img, tile):
+    result, elapse = engine(np.asarray(img.crop(tile)))
+    _record_elapse(elapse)
+    return OcrBoxes.from_ocr(result).translate(tile[0], tile[1])
+
+
+def _merge_text(a, b):
+    """兩段在接縫處被切開的文字：a 的結尾與 b 的開頭重疊的部分只保留一次。"""
+    for n in range(min(len(a), len(b)), 0, -1):
+        if a.endswith(b[:n]):
+            return a + b[n:]
+    return a + b
+
+
+def _same_text(a, b):
+    """較短的一段 (忽略空白) 是否幾乎完整地出現在較長的一段裡。"""
+    a, b = sorted(("".join(a.split()), "".join(b.split())), key=len)
+    if not a:
+        return True
+    matched = sum(m.size for m in difflib.SequenceMatcher(None, a, b, autojunk=False).get_matching_blocks())
+    return matched >= TILE_DEDUP_TEXT * len(a)
+
+
+def merge_tiles(parts, tiles, size):
+    """
+    合併各方塊的結果 (座標已換算回整頁)：
+    - 分別被相對的兩條接縫切到 (一個切在右 / 下緣、另一個切在左 / 上緣)、位於同一行的兩段
+      是同一行字的前後半，合併成一個框並接起文字；重疊比例再高也不當成重複；
+    - 其餘不同方塊中交集佔較小框 TILE_DEDUP_OVERLAP 以上、文字互相包含的框是同一段字，
+      保留沒被接縫切到 (或較大) 的那個；文字不互相包含但在同一行的，也當成前後半接起來。
+    """
+    boxes = OcrBoxes.concat(parts)
+    if len(parts) < 2 or not len(boxes):
+        return boxes
+    tile_of = np.concatenate([np.full(len(p), i) for i, p in enumerate(parts)])
+    t = np.asarray(tiles, dtype=np.float64)[tile_of]
+    c = boxes.coords
+    # 貼在方塊內側邊界 (不是整頁邊界) 的框，可能只是一段字的一部分
+    seam = np.array([t[:, 0] > 0, t[:, 1] > 0, t[:, 2] < size[0], t[:, 3] < size[1]]).T
+    tol = np.maximum(2, TILE_CUT_TOLERANCE_EM * (c[:, 3] - c[:, 1]))[:, None]
+    cut = (np.abs(c - t) <= tol) & seam  # 每個框的 左 / 上 / 右 / 下 是否被接縫切到
+    clipped = cut.any(axis=1)
+
+    polys = shapely.box(c[:, 0], c[:, 1], c[:, 2], c[:, 3])
+    area = shapely.area(polys)
+    i, j = shapely.STRtree(polys).query(polys, predicate="intersects")
+    keep = (i < j) & (tile_of[i] != tile_of[j])
+    i, j = i[keep], j[keep]
+    inter = shapely.area(shapely.intersection(polys[i], polys[j]))
+    ratio = inter / np.maximum(np.minimum(area[i], area[j]), 1)
+
+    drop = np.zeros(len(boxes), dtype=bool)
+    order = np.argsort(-ratio, kind="stable")
+    for a, b, r in zip(i[order].tolist(), j[order].tolist(), ratio[order].tolist()):
+        if drop[a] or drop[b]:
+            continue
+        facing = ((cut[a, 2] and cut[b, 0]) or (cut[b, 2] and cut[a, 0])
+                  or (cut[a, 3] and cut[b, 1]) or (cut[b, 3] and cut[a, 1]))
+        row = min(c[a, 3], c[b, 3]) - max(c[a, 1], c[b, 1])
+        same_row = row > 0.5 * min(c[a, 3] - c[a, 1], c[b, 3] - c[b, 1])
+        duplicate = r >= TILE_DEDUP_OVERLAP and _same_text(boxes.text[a], boxes.text[b])
+        if same_row and (facing or (r >= TILE_DEDUP_OVERLAP and not duplicate)):
+            first, second = (a, b) if (c[a, 0], c[a, 1]) <= (c[b, 0], c[b, 1]) else (b, a)
+            # 合併後每一邊沿用提供該邊座標的那一段的切邊狀態
+            lo, hi = np.minimum(c[a], c[b]), np.maximum(c[a], c[b])
+            edge = np.array([lo[0], lo[1], hi[2], hi[3]])
+            cut[first] = np.where(c[a] == edge, cut[a], False) | np.where(c[b] == edge, cut[b], False)
+            clipped[first] = cut[first].any()
+            c[first] = edge
+            boxes.orig[first] = edge
+            boxes.text[first] = _merge_text(boxes.text[first], boxes.text[second])
+            drop[second] = True
+        elif duplicate:
+            # 同一段字：優先留下沒被切到的，其次留下面積較大的
+            worse = b if (clipped[a], -area[a]) <= (clipped[b], -area[b]) else a
+            drop[worse] = True
+
+    merged = boxes.take(np.flatnonzero(~drop))
+    merged.recompute_fonts()
+    # 依閱讀順序 (上 → 下、左 → 右) 排列
+    return merged.take(np.lexsort((merged.coords[:, 0], merged.coords[:, 1])))
+
+
+def ocr_tiled(get_engine, img, parallel_tiles=False):
+    """
+    大頁面：必要時先縮到 OCR_MAX_PIXELS 以內，再分塊辨識、合併，座標換算回原圖。
+    parallel_tiles=True 時方塊由 OCR_TILE_WORKERS 個執行緒各自的模型辨識，不經過 get_engine。
+    """
+    scale = 1.0
+    if img.width * img.height > OCR_MAX_PIXELS:
+        scale = (OCR_MAX_PIXELS / (img.width * img.height)) ** 0.5
+        img = img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))), Image.LANCZOS)
+    tiles = tile_grid(img.size)
+    if parallel_tiles and OCR_TILE_WORKERS > 1 and len(tiles) > 1:
+        executor = _get_tile_executor()
+        parts = list(executor.map(lambda tile: _ocr_tile(_thread_engine(), img, tile), tiles))
+    else:
+        engine = get_engine()
+        parts = [_ocr_tile(engine, img, tile) for tile in tiles]
+    boxes = merge_tiles(parts, tiles, img.size)
+    if scale != 1.0:
+        boxes.coords /= scale
+        boxes.orig /= scale
+        boxes.recompute_fonts()
+    return boxes
+
+
+def ocr_image(get_engine, img, parallel_tiles=False):
+    if needs_tiling(img.size):
+        return ocr_tiled(get_engine, img, parallel_tiles)
+    result, elapse = get_engine()(np.array(img))
+    _record_elapse(elapse)
+    return OcrBoxes.from_ocr(result)
+
+
+def run_ocr(get_engine, img, cache=None, parallel_tiles=False):
+    """get_engine 是回傳 RapidOCR 實例的函式，快取命中時就不必載入模型。"""
+    key = None
+    if cache is not None:
+        key = ocr_cache_key(img)
+        records = cache.get(key)
+        if records is not None:
+            METRICS.count("ocr_cache_hit")
+            return OcrBoxes.from_records(records)
+        METRICS.count("ocr_cache_miss")
+    with METRICS.span("ocr", size=f"{img.width}x{img.height}"):
+        boxes = ocr_image(get_engine, img, parallel_tiles)
+    if cache is not None:
+        cache.put(key, boxes.to_records())
+    return boxes
+
+
+# --- 文字層快速路徑 ---
+def _pdf_color(value):
+    """pdfplumber 的 non_stroking_color (灰階 / RGB / CMYK，0–1) → "#rrggbb"；其他 (pattern 等) 當成黑色。"""
+    if isinstance(value, (int, float)):
+        value = (value,)
+    if not isinstance(value, (tuple, list)) or not all(isinstance(v, (int, float)) for v in value):
+        return "#000000"
+    if len(value) == 1:
+        rgb = value * 3
+    elif len(value) == 3:
+        rgb = value
+    elif len(value) == 4:
+        c, m, y, k = value
+        rgb = ((1 - c) * (1 - k), (1 - m) * (1 - k), (1 - y) * (1 - k))
+    else:
+        return "#000000"
+    return "#" + "".join(f"{int(round(min(1, max(0, v)) * 255)):02x}" for v in rgb)
+
+
+def _usable_chars(chars):
+    visible = [c for c in chars if c['text'].strip()]
+    if len(visible) < TEXT_LAYER_MIN_CHARS:
+        return False
+    cid = sum(1 for c in visible if c['text'].startswith("(cid:"))
+    return cid / len(visible) <= TEXT_LAYER_MAX_CID_RATIO
+
+
+def _word_size(word):
+    return float(np.median([c['size'] for c in word['chars']]))
+
+
+def _text_segments(words):
+    """
+    extract_words 的字詞 → 每個框的字詞串列：先依 top 分行，同一行再在大間距處切開，
+    同一條基線上分屬不同欄位 / 文字框的字不會被併成一個框。
+    """
+    rows = []
+    for word in sorted(words, key=lambda w: (w['top'], w['x0'])):
+        if rows and word['top'] - rows[-1][0]['top'] <= TEXT_LINE_Y_TOLERANCE:
+            rows[-1].append(word)
+        else:
+            rows.append([word])
+    segments = []
+    for row in rows:
+        row.sort(key=lambda w: w['x0'])
+        segment = [row[0]]
+        for word in row[1:]:
+            prev = segment[-1]
+            if word['x0'] - prev['x1'] > max(_word_size(prev), _word_size(word)) * TEXT_BOX_GAP_EM:
+                segments.append(segment)
+                segment = []
+            segment.append(word)
+        segments.append(segment)
+    return segments
+
+
+class TextLayer:
+    """
+    以 pdfplumber 讀取頁面文字層，換算成 dpi 下的像素座標 (與渲染出來的底圖對齊)。
+    extract() 回傳 (OcrBoxes 或 None, 需要 OCR 的圖片區域)；None 表示這頁沒有可用的文字層。
+    """
+
+    def __init__(self, data):
+        self.pdf = pdfplumber.open(io.BytesIO(data))
+        self._lock = threading.Lock()
+
+    def extract(self, page_idx, dpi):
+        with self._lock:
+            page = self.pdf.pages[page_idx]
+            try:
+                # 旋轉頁面的座標換算交給 OCR，避免框跟底圖對不上
+                if page.rotation % 360 or not _usable_chars(page.chars):
+                    return None, []
+                words = page.extract_words(return_chars=True)
+                images = [(img['x0'], img['top'], img['x1'], img['bottom']) for img in page.images]
+                left, top, right, bottom = page.cropbox
+            finally:
+                page.close()
+
+        scale = dpi / 72
+        width, height = (right - left) * scale, (bottom - top) * scale
+        coords, text, sizes, strokes, colors = [], [], [], [], []
+        for segment in _text_segments(words):
+            chars = [c for w in segment for c in w['chars'] if c['text'].strip()] or segment[0]['chars']
+            coords.append([min(w['x0'] for w in segment), min(w['top'] for w in segment),
+                           max(w['x1'] for w in segment), max(w['bottom'] for w in segment)])
+            text.append(" ".join(w['text'] for w in segment))
+            sizes.append(np.median([c['size'] for c in chars]))
+            strokes.append(2 if any("bold" in (c.get('fontname') or "").lower() for c in chars) else 0)
+            colors.append(_pdf_color(chars[0].get('non_stroking_color')))
+
+        origin = np.array([left, top, left, top], dtype=np.float64)
+        coords = (np.asarray(coords, dtype=np.float64).reshape(-1, 4) - origin) * scale
+        font_size = np.maximum(10, np.rint(np.asarray(sizes, dtype=np.float64) * scale)).astype(np.int32)
+        boxes = OcrBoxes(coords, text, None, font_size, strokes, colors)
+
+        regions = []
+        for box in (np.asarray(images, dtype=np.float64).reshape(-1, 4) - origin) * scale:
+            x0, y0 = max(0, int(box[0])), max(0, int(box[1]))
+            x1, y1 = min(int(width), int(np.ceil(box[2]))), min(int(height), int(np.ceil(box[3])))
+            if x1 - x0 >= IMAGE_REGION_MIN_PX and y1 - y0 >= IMAGE_REGION_MIN_PX:
+                regions.append((x0, y0, x1, y1))
+        return boxes, regions
+
+    def close(self):
+        self.pdf.close()
+
+
+def _outside(boxes, covered):
+    """boxes 中中心點不在 covered 任何一個框內的索引。"""
+    if not len(covered):
+        return np.arange(len(boxes))
+    cx = (boxes.coords[:, 0] + boxes.coords[:, 2])[:, None] / 2
+    cy = (boxes.coords[:, 1] + boxes.coords[:, 3])[:, None] / 2
+    c = covered.coords
+    inside = (cx >= c[:, 0]) & (cx <= c[:, 2]) & (cy >= c[:, 1]) & (cy <= c[:, 3])
+    return np.flatnonzero(~inside.any(axis=1))
+
+
+def analyze_page(get_engine, img, cache=None, text_layer=None, page_idx=None, dpi=None, parallel_tiles=False):
+    """
+    分析一頁：有可用文字層時直接用文字層，只對頁面上的圖片區域跑 OCR
+    (與文字層重疊的 OCR 結果會丟掉)；沒有文字層、或 text_layer 為 None 時整頁 OCR。
+    parallel_tiles 見 ocr_tiled：只有獨占整台機器的呼叫者 (單人互動、pdf_engine.analyze) 才開。
+    """
+    with METRICS.span("analyze", page_idx, dpi):
+        if text_layer is None or ANALYSIS_MODE == "ocr":
+            return run_ocr(get_engine, img, cache, parallel_tiles)
+        with METRICS.span("text_layer", page_idx, dpi):
+            boxes, regions = text_layer.extract(page_idx, dpi)
+        if boxes is None:
+            return run_ocr(get_engine, img, cache, parallel_tiles)
+        parts = [boxes]
+        for x0, y0, x1, y1 in regions:
+            found = run_ocr(get_engine, img.crop((x0, y0, x1, y1)), cache, parallel_tiles).translate(x0, y0)
+            parts.append(found.take(_outside(found, boxes)))
+        return OcrBoxes.concat(parts)
+
+
+def plan_workers(n_pages, workers=None):
+    """決定 worker 數與每個 ONNX session 的 intra-op 執行緒數，兩者相乘約等於核心數。"""
+    cores = os.cpu_count() or 1
+    if not workers:
+        workers = max(1, cores // 2)
+    workers = max(1, min(workers, n_pages))
+    threads = max(1, cores // workers)
+    return workers, threads
+
+
+# --- worker 行程 ---
+_worker = {}
+
+
+def _init_worker(data, dpi, threads, backend, cache_path):
+    _worker['renderer'] = open_renderer(data, backend)
+    _worker['text_layer'] = TextLayer(data) if ANALYSIS_MODE != "ocr" else None
+    _worker['threads'] = threads
+    _worker['engine'] = None
+    _worker['dpi'] = dpi
+    _worker['cache'] = OcrCache(cache_path) if cache_path else None
+
+
+def _worker_engine():
+    # 模型延後到第一次快取未命中時才載入
+    if _worker['engine'] is None:
+        _worker['engine'] = create_engine(_worker['threads'])
+    return _worker['engine']
+
+
+def _ocr_page(page_idx):
+    img = _worker['renderer'].render(page_idx, _worker['dpi'])
+    return analyze_page(_worker_engine, img, _worker['cache'], _worker['text_layer'], page_idx, _worker['dpi'])
+
+
+class BatchOcrJob:
+    """
+    在背景把多頁丟給 process pool 做 OCR。
+
+    結果在完成時先放進內部緩衝區，由呼叫端 (Streamlit script thread) 以 drain()
+    取出再寫入 session_state；cancel() 會取消尚未開始的頁面。
+    """
+
+    def __init__(self, data, pages, dpi, workers=None, backend=None, cache_path=None):
+        self.pages = list(pages)
+        self.total = len(self.pages)
+        self.completed = 0
+        self.errors = {}
+        self.cancelled = False
+        self._results = []
+        self._lock = threading.Lock()
+
+        n_workers, threads = plan_workers(self.total, workers)
+        self._executor = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(data, dpi, threads, backend, cache_path),
+        )
+        self._futures = {}
+        for page_idx in self.pages:
+            future = self._executor.submit(_ocr_page, page_idx)
+            self._futures[future] = page_idx
+            future.add_done_callback(self._on_done)
+
+    def _on_done(self, future):
+        page_idx = self._futures[future]
+        with self._lock:
+            if future.cancelled():
+                return
+            self.completed += 1
+            exc = future.exception()
+            if exc is not None:
+                self.errors[page_idx] = exc
+            else:
+                self._results.append((page_idx, future.result()))
+            finished = self.completed == self.total
+        if finished:
+            self._executor.shutdown(wait=False)
+
+    @property
+    def done(self):
+        with self._lock:
+            return self.cancelled or self.completed == self.total
+
+    @property
+    def progress(self):
+        return self.completed / self.total if self.total else 1.0
+
+    def drain(self):
+        """取出目前已完成、尚未取走的 [(page_idx, OcrBoxes), ...]。"""
+        with self._lock:
+            results, self._results = self._results, []
+        return results
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,115 @@
+"""
+頁面點陣化後端。
+
+所有需要把 PDF 頁面轉成圖片的地方 (縮圖、工作區底圖、匯出) 都透過這裡，
+預設使用 pypdfium2，直接輸出不透明的 RGB 圖片，不必再經過 sanitize_image。
+舊的 pdfplumber.to_image 路徑保留為 "pdfplumber" 後端，方便比較與除錯。
+"""
+import io
+import os
+import threading
+
+import pdfplumber
+import pypdfium2 as pdfium
+from PIL import Image
+
+from pdf_metrics import METRICS
+
+# pdfium 本身不是 thread-safe (即使是不同文件也一樣)，
+# pdfplumber.to_image 內部也是呼叫 pdfium，所以兩個後端共用同一把鎖。
+PDFIUM_LOCK = threading.Lock()
+
+DEFAULT_BACKEND = os.environ.get("PDF_TOOL_RENDERER", "pdfium")
+
+
+# --- 針對雲端 P 模式與透明圖層的終極清洗 (暴力白底版) ---
+def sanitize_image(pil_image):
+    """
+    不管圖片原本是什麼格式，一律建立一張「純白」的底圖，
+    然後把原圖貼上去。這能確保透明背景一定會變成白色，解決變黑問題。
+    """
+    # 1. 確保原圖是 RGBA (包含透明度資訊)，這樣貼上時才不會破圖
+    pil_image = pil_image.convert('RGBA')
+
+    # 2. 建立一張同樣大小的「純白色」底圖
+    new_image = Image.new('RGB', pil_image.size, (255, 255, 255))
+
+    # 3. 將原圖貼在白底上 (使用 alpha 作為遮罩)
+    new_image.paste(pil_image, (0, 0), pil_image)
+
+    # 4. 直接回傳這張新的 RGB 圖片
+    return new_image
+
+
+class PdfiumRenderer:
+    """以白色不透明底色直接渲染成 RGB 點陣圖。"""
+    name = "pdfium"
+
+    def __init__(self, data):
+        with PDFIUM_LOCK, METRICS.span("parse", backend=self.name):
+            self.doc = pdfium.PdfDocument(data)
+            self.page_count = len(self.doc)
+
+    def render(self, page_idx, dpi):
+        with PDFIUM_LOCK, METRICS.span("render", page_idx, dpi, backend=self.name):
+            page = self.doc[page_idx]
+            try:
+                bitmap = page.render(
+                    scale=dpi / 72,
+                    fill_color=(255, 255, 255, 255),
+                    may_draw_forms=True,
+                    rev_byteorder=True,
+                )
+                img = bitmap.to_pil()
+            finally:
+                page.close()
+        return img if img.mode == "RGB" else img.convert("RGB")
+
+    def page_size(self, page_idx):
+        """(寬, 高)，單位為點，已考慮 /Rotate。"""
+        with PDFIUM_LOCK:
+            page = self.doc[page_idx]
+            try:
+                return page.get_size()
+            finally:
+                page.close()
+
+    def close(self):
+        with PDFIUM_LOCK:
+            self.doc.close()
+
+
+class PdfplumberRenderer:
+    """原本的 pdfplumber.to_image 路徑 (RGBA → 白底 RGB)。"""
+    name = "pdfplumber"
+
+    def __init__(self, data):
+        with PDFIUM_LOCK, METRICS.span("parse", backend=self.name):
+            self.pdf = pdfplumber.open(io.BytesIO(data))
+            self.page_count = len(self.pdf.pages)
+
+    def render(self, page_idx, dpi):
+        with PDFIUM_LOCK, METRICS.span("render", page_idx, dpi, backend=self.name):
+            raw = self.pdf.pages[page_idx].to_image(resolution=dpi).original
+        with METRICS.span("sanitize_image", page_idx, dpi):
+            return sanitize_image(raw)
+
+    def page_size(self, page_idx):
+        page = self.pdf.pages[page_idx]
+        return page.width, page.height
+
+    def close(self):
+        self.pdf.close()
+
+
+RENDERERS = {
+    PdfiumRenderer.name: PdfiumRenderer,
+    PdfplumberRenderer.name: PdfplumberRenderer,
+}
+
+
+def open_renderer(data, backend=None):
+    backend = backend or DEFAULT_BACKEND
+    if backend not in RENDERERS:
+        raise ValueError(f"未知的渲染後端: {backend} (可用: {', '.join(RENDERERS)})")
+    return RENDERERS[backend](data)
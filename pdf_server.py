@@ -0,0 +1,348 @@
+"""
+多人伺服器模式 (PDF_TOOL_SERVER=1)：
+
+- OcrEnginePool：所有 session 共用固定數量的 RapidOCR 實例，每次推論獨占一個。
+  互動請求 (單頁分析) 排在批次分析前面；等待的請求超過上限或等太久就回報 ServerBusy，
+  不會無限制地堆積。
+- PooledOcrJob：伺服器模式下的整份文件分析，走同一個引擎池，不再每個 session 各開一組 worker 行程。
+- PageStore：以磁碟為後端的 {鍵: 圖片}，取代 session_state 裡的 pages_data 與 Undo 裁切圖，
+  每個 session 有自己的資料夾與容量上限 (QuotaExceeded)。
+
+一般 (單人) 模式也使用 OcrEnginePool，只是大小為 1、不限排隊。
+"""
+import os
+import shutil
+import threading
+import time
+import uuid
+import weakref
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from pdf_metrics import METRICS
+from pdf_ocr import analyze_page, create_engine
+
+SERVER_MODE = os.environ.get("PDF_TOOL_SERVER") == "1"
+
+# OCR 引擎池：預設每兩個核心一個引擎，每個引擎的 intra-op 執行緒數 = 核心數 / 引擎數
+OCR_POOL_SIZE = int(os.environ.get("PDF_TOOL_OCR_POOL", max(1, (os.cpu_count() or 1) // 2)))
+OCR_QUEUE_MAX = int(os.environ.get("PDF_TOOL_OCR_QUEUE", OCR_POOL_SIZE * 2))  # 最多幾個互動請求排隊
+OCR_QUEUE_TIMEOUT = float(os.environ.get("PDF_TOOL_OCR_QUEUE_TIMEOUT", "60"))  # 排隊最久幾秒
+OCR_BATCH_MAX_PAGES = int(os.environ.get("PDF_TOOL_OCR_BATCH_MAX_PAGES", "2000"))  # 全伺服器排隊中的批次頁數上限
+
+# 頁面儲存：每個 session 一個資料夾
+STORE_ROOT = os.environ.get("PDF_TOOL_STORE", os.path.join(".cache", "sessions"))
+SESSION_QUOTA_BYTES = int(os.environ.get("PDF_TOOL_SESSION_QUOTA_MB", "1024")) * 1024 * 1024
+SESSION_TTL = 24 * 3600  # 不屬於任何活著的 session、閒置超過這麼久 (秒) 的資料夾會被清掉
+
+
+class ServerBusy(Exception):
+    pass
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+# --- OCR 引擎池 ---
+class OcrEnginePool:
+    """
+    固定大小的 RapidOCR 引擎池。RapidOCR 實例不能跨執行緒同時使用，
+    所以每次推論以 acquire() / release() 獨占一個；引擎在第一次需要時才載入。
+
+    max_waiting / timeout 只限制互動請求 (None 表示不限)；background=True 的請求
+    (批次分析) 一律排隊，而且只有在沒有互動請求等待時才會拿到引擎。
+    """
+
+    def __init__(self, size=1, max_waiting=None, timeout=None, threads=None):
+        self.size = size
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.threads = threads
+        self.in_use = 0
+        self.waiting = 0
+        self.waiting_background = 0
+        self.rejected = 0
+        self._idle = []
+        self._cond = threading.Condition()
+
+    def _gauges(self):
+        METRICS.gauge("ocr_pool_in_use", self.in_use)
+        METRICS.gauge("ocr_pool_waiting", self.waiting + self.waiting_background)
+
+    def _reject(self, reason):
+        self.rejected += 1
+        METRICS.count("ocr_pool_rejected")
+        raise ServerBusy(reason)
+
+    def acquire(self, background=False):
+        start = time.perf_counter()
+        with self._cond:
+            if background:
+                self.waiting_background += 1
+                self._gauges()
+                try:
+                    self._cond.wait_for(lambda: self.in_use < self.size and not self.waiting)
+                finally:
+                    self.waiting_background -= 1
+            else:
+                if self.in_use >= self.size and self.max_waiting is not None and self.waiting >= self.max_waiting:
+                    self._reject("OCR 伺服器忙碌中，請稍後再試")
+                self.waiting += 1
+                self._gauges()
+                try:
+                    ready = self._cond.wait_for(lambda: self.in_use < self.size, self.timeout)
+                finally:
+                    self.waiting -= 1
+                if not ready:
+                    self._cond.notify_all()
+                    self._reject("等待 OCR 逾時，請稍後再試")
+            self.in_use += 1
+            engine = self._idle.pop() if self._idle else None
+            self._gauges()
+        METRICS.record("ocr.queue_wait", time.perf_counter() - start, background=background)
+        if engine is None:
+            try:
+                engine = create_engine(self.threads)
+            except BaseException:
+                self.release(None)
+                raise
+        return engine
+
+    def release(self, engine):
+        with self._cond:
+            if engine is not None:
+                self._idle.append(engine)
+            self.in_use -= 1
+            self._gauges()
+            self._cond.notify_all()
+
+    def lease(self, background=False):
+        return EngineLease(self, background)
+
+
+class EngineLease:
+    """
+    with pool.lease() as lease: analyze_page(lease.get, ...)
+
+    get 就是 analyze_page 要的 get_engine：只有真的要推論 (快取未命中、沒有文字層) 時才去排隊，
+    離開 with 時歸還。
+    """
+
+    def __init__(self, pool, background=False):
+        self.pool = pool
+        self.background = background
+        self.engine = None
+
+    def get(self):
+        if self.engine is None:
+            self.engine = self.pool.acquire(self.background)
+        return self.engine
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.engine is not None:
+            self.pool.release(self.engine)
+            self.engine = None
+
+
+# --- 伺服器模式的批次分析 ---
+# 所有 session 的批次頁面共用一個執行緒池 (大小 = 引擎池大小)，依提交順序處理。
+_batch_executor = None
+_batch_lock = threading.Lock()
+_batch_pending = 0
+
+
+def _get_batch_executor(workers):
+    global _batch_executor
+    with _batch_lock:
+        if _batch_executor is None:
+            _batch_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr-batch")
+        return _batch_executor
+
+
+class PooledOcrJob:
+    """與 BatchOcrJob 相同的介面 (done / progress / drain / cancel / errors)，但使用共用的引擎池。"""
+
+    def __init__(self, doc, pages, dpi, pool, cache=None, max_pending=OCR_BATCH_MAX_PAGES):
+        global _batch_pending
+        self.pages = list(pages)
+        self.total = len(self.pages)
+        with _batch_lock:
+            if _batch_pending + self.total > max_pending:
+                METRICS.count("ocr_batch_rejected")
+                raise ServerBusy("排隊中的批次分析太多，請稍後再試")
+            _batch_pending += self.total
+        self.completed = 0
+        self.errors = {}
+        self.cancelled = False
+        self._doc = doc
+        self._dpi = dpi
+        self._pool = pool
+        self._cache = cache
+        self._results = []
+        self._lock = threading.Lock()
+
+        executor = _get_batch_executor(pool.size)
+        self._futures = {}
+        for page_idx in self.pages:
+            future = executor.submit(self._analyze, page_idx)
+            self._futures[future] = page_idx
+            future.add_done_callback(self._on_done)
+
+    def _analyze(self, page_idx):
+        # 直接渲染，不經過文件的點陣圖快取，避免把互動中頁面的快取擠掉
+        img = self._doc.rasterize(page_idx, self._dpi)
+        with self._pool.lease(background=True) as lease:
+            return analyze_page(lease.get, img, self._cache, self._doc.text_layer, page_idx, self._dpi)
+
+    def _on_done(self, future):
+        global _batch_pending
+        with _batch_lock:
+            _batch_pending -= 1
+        page_idx = self._futures[future]
+        with self._lock:
+            if future.cancelled():
+                return
+            self.completed += 1
+            exc = future.exception()
+            if exc is not None:
+                self.errors[page_idx] = exc
+            else:
+                self._results.append((page_idx, future.result()))
+
+    @property
+    def done(self):
+        with self._lock:
+            return self.cancelled or self.completed == self.total
+
+    @property
+    def progress(self):
+        return self.completed / self.total if self.total else 1.0
+
+    def drain(self):
+        """取出目前已完成、尚未取走的 [(page_idx, OcrBoxes), ...]。"""
+        with self._lock:
+            results, self._results = self._results, []
+        return results
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+        for future in self._futures:
+            future.cancel()
+
+
+# --- 磁碟頁面儲存 ---
+_live_dirs = set()
+
+
+def _remove_dir(directory):
+    _live_dirs.discard(directory)
+    shutil.rmtree(directory, ignore_errors=True)
+    try:
+        os.rmdir(os.path.dirname(directory))  # session 資料夾空了就一起刪
+    except OSError:
+        pass
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class PageStore(MutableMapping):
+    """
+    以磁碟為後端的 {鍵: PIL 圖片}，可以直接取代 session_state 裡的 dict。
+
+    每張圖存成一個未壓縮的 .npy，讀寫都只是一次循序 I/O，常用的頁面由 OS page cache 承擔；
+    記憶體裡只留鍵與大小。取出的是新的圖片物件，修改後要再寫回去才會生效。
+    quota_bytes 是這個儲存區的容量上限，寫入會超過時丟出 QuotaExceeded (原本的內容不變)。
+    物件被回收 (session 結束) 或呼叫 close() 時刪除資料夾。
+    """
+
+    def __init__(self, directory, quota_bytes=None):
+        self.directory = os.path.abspath(directory)
+        self.quota_bytes = quota_bytes
+        self.used_bytes = 0
+        self._index = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        _live_dirs.add(self.directory)
+        self._finalizer = weakref.finalize(self, _remove_dir, self.directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npy")
+
+    def __getitem__(self, key):
+        if key not in self._index:
+            raise KeyError(key)
+        return Image.fromarray(np.load(self._path(key)))
+
+    def __setitem__(self, key, img):
+        arr = np.asarray(img)
+        path = self._path(key)
+        with self._lock:
+            used = self.used_bytes - self._index.get(key, 0) + arr.nbytes
+            if self.quota_bytes is not None and used > self.quota_bytes:
+                METRICS.count("store_quota_exceeded")
+                raise QuotaExceeded(f"已超過每個工作階段 {self.quota_bytes // 1024 // 1024} MB 的儲存空間上限")
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, arr)
+            os.replace(path + ".tmp", path)
+            self._index[key] = arr.nbytes
+            self.used_bytes = used
+
+    def __delitem__(self, key):
+        with self._lock:
+            self.used_bytes -= self._index.pop(key)
+            os.remove(self._path(key))
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(list(self._index))
+
+    def __len__(self):
+        return len(self._index)
+
+    def snapshot(self):
+        """目前內容的唯讀快照 (硬連結，之後的寫入不會影響它)，給背景匯出用；用完要 close()。"""
+        snap = PageStore(os.path.join(self.directory, f".snapshot-{uuid.uuid4().hex}"))
+        with self._lock:
+            for key, nbytes in self._index.items():
+                _link_or_copy(self._path(key), snap._path(key))
+                snap._index[key] = nbytes
+            snap.used_bytes = self.used_bytes
+        return snap
+
+    def close(self):
+        self._finalizer()
+
+
+def session_dir(session_id, root=STORE_ROOT):
+    return os.path.join(root, session_id)
+
+
+def sweep_sessions(root=STORE_ROOT, max_age=SESSION_TTL):
+    """刪除不屬於這個行程中任何 session、而且閒置超過 max_age 秒的資料夾 (例如伺服器重啟前留下的)。"""
+    if not os.path.isdir(root):
+        return
+    now = time.time()
+    for name in os.listdir(root):
+        path = os.path.abspath(os.path.join(root, name))
+        if any(d == path or d.startswith(path + os.sep) for d in list(_live_dirs)):
+            continue
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
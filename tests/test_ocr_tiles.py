@@ -0,0 +1,65 @@
+import numpy as np
+
+from pdf_ocr import OcrBoxes, merge_tiles, tile_grid
+
+
+def _part(*items):
+    return OcrBoxes([coords for coords, _ in items], [text for _, text in items])
+
+
+def test_tile_grid_small_image_is_one_tile():
+    assert tile_grid((1200, 900), tile=1600, overlap=200) == [(0, 0, 1200, 900)]
+
+
+def test_tile_grid_covers_image_with_overlap():
+    size = (3000, 1000)
+    tiles = tile_grid(size, tile=1600, overlap=200)
+    assert tiles == [(0, 0, 1600, 1000), (1400, 0, 3000, 1000)]
+
+    tiles = tile_grid((4100, 3500), tile=1600, overlap=200)
+    xs = sorted({t[0] for t in tiles})
+    ys = sorted({t[1] for t in tiles})
+    assert len(tiles) == len(xs) * len(ys)
+    assert max(t[2] for t in tiles) == 4100 and max(t[3] for t in tiles) == 3500
+    for starts in (xs, ys):
+        assert starts[0] == 0
+        assert all(b - a <= 1400 for a, b in zip(starts, starts[1:]))  # 相鄰方塊至少重疊 200
+    assert all(t[2] - t[0] == 1600 and t[3] - t[1] == 1600 for t in tiles)
+
+
+def test_merge_joins_line_cut_at_seam():
+    # 一行字被接縫切成兩半，兩半在重疊區的交集比例超過 TILE_DEDUP_OVERLAP，仍然要接起來而不是當成重複
+    tiles = [(0, 0, 1600, 1000), (1400, 0, 3000, 1000)]
+    parts = [_part(([1300, 100, 1600, 140], "Hello wor")),
+             _part(([1400, 100, 1800, 140], "world again"))]
+    merged = merge_tiles(parts, tiles, (3000, 1000))
+    assert merged.text == ["Hello world again"]
+    np.testing.assert_array_equal(merged.coords[0], [1300, 100, 1800, 140])
+
+
+def test_merge_drops_duplicate_in_overlap():
+    # 整段字落在重疊區：兩個方塊都完整辨識到，只留一個
+    tiles = [(0, 0, 1600, 1000), (1400, 0, 3000, 1000)]
+    parts = [_part(([1420, 300, 1560, 340], "dup"), ([100, 500, 400, 540], "left")),
+             _part(([1421, 301, 1559, 340], "dup"), ([2000, 500, 2300, 540], "right"))]
+    merged = merge_tiles(parts, tiles, (3000, 1000))
+    assert merged.text == ["dup", "left", "right"]
+
+
+def test_merge_prefers_unclipped_copy():
+    # 左邊方塊只看到被切掉的一半，右邊方塊看到完整的字：留完整的那個
+    tiles = [(0, 0, 1600, 1000), (1400, 0, 3000, 1000)]
+    parts = [_part(([1450, 100, 1600, 140], "Hel")),
+             _part(([1450, 100, 1700, 140], "Hello"))]
+    merged = merge_tiles(parts, tiles, (3000, 1000))
+    assert merged.text == ["Hello"]
+
+
+def test_merge_joins_line_with_inset_boxes():
+    # RapidOCR 的框比字的邊緣內縮：左半在接縫前 3px 結束、右半在接縫後 6px 才開始，仍然是同一行的前後半
+    tiles = [(0, 0, 1600, 1000), (1400, 0, 3000, 1000)]
+    parts = [_part(([1299, 243, 1597, 289], "line number 1 sp")),
+             _part(([1406, 250, 2061, 289], "umber 1 spanning the seam area text"))]
+    merged = merge_tiles(parts, tiles, (3000, 1000))
+    assert merged.text == ["line number 1 spanning the seam area text"]
+    np.testing.assert_array_equal(merged.coords[0], [1299, 243, 2061, 289])